@@ -0,0 +1,138 @@
+import collections
+import logging
+import os
+from urllib.parse import quote, unquote
+
+# set up the logger
+log = logging.getLogger('ddmbot.audiocache')
+
+
+def _quote(value):
+    # dots are escaped as well, so the single dot separates the uuri from the codec in the file names
+    return quote(value, safe='').replace('.', '%2E')
+
+
+class AudioCache:
+    _extension = '.mka'
+    _partial_extension = '.part'
+
+    def __init__(self, config):
+        self._directory = config['cache_dir']
+        self._size_limit = int(config['cache_size']) * 2**20
+        if self._size_limit < 0:
+            raise ValueError('Provided \'cache_size\' is invalid')
+
+        # maps song uuri -> (file size, audio codec), ordered by the last access (least recently used first)
+        self._entries = collections.OrderedDict()
+        self._total_size = 0
+        # maps song uuri -> audio codec of the songs being stored
+        self._pending = dict()
+
+        if not self.enabled:
+            return
+
+        os.makedirs(self._directory, mode=0o700, exist_ok=True)
+
+        # populate the entries from the previous runs, use access times to restore the order
+        files = list()
+        for entry in os.scandir(self._directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(self._partial_extension):
+                # unfinished downloads are useless
+                os.remove(entry.path)
+            elif entry.name.endswith(self._extension):
+                uuri, separator, codec = entry.name[:-len(self._extension)].partition('.')
+                if not separator:
+                    # files stored without the codec cannot be played without looking up their source
+                    os.remove(entry.path)
+                    continue
+                stat = entry.stat()
+                files.append((stat.st_mtime, unquote(uuri), unquote(codec), stat.st_size))
+        for _, uuri, codec, size in sorted(files):
+            self._entries[uuri] = (size, codec)
+            self._total_size += size
+
+        log.info('Audio cache contains {} song(s), {} MiB in total'.format(len(self._entries),
+                                                                           self._total_size // 2**20))
+        self._evict()
+
+    @property
+    def enabled(self):
+        return bool(self._directory) and self._size_limit > 0
+
+    def get(self, uuri):
+        if uuri not in self._entries:
+            return None
+        path = self._path(uuri, self._entries[uuri][1])
+        try:
+            # modification time is used to persist the access order
+            os.utime(path)
+        except FileNotFoundError:
+            log.warning('Cached file for the song {} disappeared'.format(uuri))
+            self._total_size -= self._entries.pop(uuri)[0]
+            return None
+        self._entries.move_to_end(uuri)
+        return path
+
+    def lookup(self, uuri):
+        # returns (path, codec) of the cached song, None if it is not cached, the access order is not changed
+        # may be called from other threads
+        entry = self._entries.get(uuri)
+        if entry is None:
+            return None
+        return self._path(uuri, entry[1]), entry[1] or None
+
+    def temporary_path(self, uuri, codec=None):
+        # codec is remembered, so the song can be played without looking up its source again
+        # returns None if the song is being stored already, the file must have a single writer
+        if uuri in self._pending:
+            return None
+        self._pending[uuri] = codec or ''
+        return self._partial_path(uuri)
+
+    def commit(self, uuri):
+        codec = self._pending.pop(uuri, '')
+        partial_path = self._partial_path(uuri)
+        try:
+            size = os.path.getsize(partial_path)
+            os.replace(partial_path, self._path(uuri, codec))
+        except FileNotFoundError:
+            log.warning('Cannot store the song {} in the cache, file not found'.format(uuri))
+            return
+
+        if uuri in self._entries:
+            old_size, old_codec = self._entries.pop(uuri)
+            self._total_size -= old_size
+            if old_codec != codec:
+                self._remove(uuri, old_codec)
+        self._entries[uuri] = (size, codec)
+        self._total_size += size
+        log.debug('Song {} stored in the cache ({} bytes)'.format(uuri, size))
+        self._evict()
+
+    def discard(self, uuri):
+        self._pending.pop(uuri, None)
+        try:
+            os.remove(self._partial_path(uuri))
+        except FileNotFoundError:
+            pass
+
+    def _path(self, uuri, codec):
+        return os.path.join(self._directory, '{}.{}{}'.format(_quote(uuri), _quote(codec), self._extension))
+
+    def _partial_path(self, uuri):
+        return os.path.join(self._directory, _quote(uuri) + self._extension + self._partial_extension)
+
+    def _remove(self, uuri, codec):
+        try:
+            os.remove(self._path(uuri, codec))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self._total_size > self._size_limit and self._entries:
+            uuri, (size, codec) = self._entries.popitem(last=False)
+            self._total_size -= size
+            log.debug('Song {} evicted from the cache'.format(uuri))
+            self._remove(uuri, codec)
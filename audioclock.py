@@ -0,0 +1,112 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import time
+from math import ceil
+
+# set up the logger
+log = logging.getLogger('ddmbot.audioclock')
+
+# clock_nanosleep constants, extracted from linux API headers
+_CLOCK_MONOTONIC = 1
+_TIMER_ABSTIME = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+# absolute deadlines are used if clock_nanosleep is available, relative sleep is used as a fallback
+try:
+    _clock_nanosleep = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).clock_nanosleep
+    _clock_nanosleep.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(_Timespec), ctypes.POINTER(_Timespec)]
+except (OSError, AttributeError):
+    log.warning('clock_nanosleep is not available, falling back to relative sleep')
+    _clock_nanosleep = None
+
+
+def _now():
+    return time.clock_gettime(time.CLOCK_MONOTONIC)
+
+
+class Pacer:
+    def __init__(self, clock, name, period):
+        self._clock = clock
+        self._name = name
+        self._period = period
+        self._tick = 0
+        self._deadline = _Timespec()
+
+        self._late_frames = 0
+        self._resyncs = 0
+
+    @property
+    def late_frames(self):
+        return self._late_frames
+
+    @property
+    def resyncs(self):
+        return self._resyncs
+
+    def start(self):
+        # ticks are aligned to the common epoch, so all the pacers stay in sync with each other
+        self._tick = ceil((_now() - self._clock.epoch) / self._period)
+
+    def wait(self):
+        self._tick += 1
+        deadline = self._clock.epoch + self._tick * self._period
+        lag = _now() - deadline
+
+        if lag <= 0:
+            self._sleep_until(deadline)
+            return
+
+        self._late_frames += 1
+        if lag >= self._clock.resync_threshold:
+            # after a long stall, missed frames are not worth sending at all, start over from now
+            self._resyncs += 1
+            self.start()
+            log.warning('{}: Clock resynchronized after a stall of {:.0f} ms, {} late frame(s) so far'
+                        .format(self._name, lag * 1000, self._late_frames))
+        elif lag > self._clock.max_catch_up:
+            # only a limited number of missed frames is sent back-to-back
+            self._tick += int((lag - self._clock.max_catch_up) / self._period)
+
+    def _sleep_until(self, deadline):
+        if _clock_nanosleep is None:
+            time.sleep(max(0, deadline - _now()))
+            return
+
+        self._deadline.tv_sec = int(deadline)
+        self._deadline.tv_nsec = int((deadline - self._deadline.tv_sec) * 1000000000)
+        while True:
+            # clock_nanosleep returns the error number directly instead of setting errno
+            result = _clock_nanosleep(_CLOCK_MONOTONIC, _TIMER_ABSTIME, ctypes.byref(self._deadline), None)
+            if result != errno.EINTR:
+                break
+
+
+class AudioClock:
+    def __init__(self, config):
+        self._max_catch_up = float(config['clock_max_catch_up'])
+        self._resync_threshold = float(config['clock_resync_threshold'])
+        if self._max_catch_up < 0 or self._resync_threshold <= self._max_catch_up:
+            raise ValueError('Provided \'clock_max_catch_up\' or \'clock_resync_threshold\' is invalid')
+
+        self._epoch = _now()
+
+    @property
+    def epoch(self):
+        return self._epoch
+
+    @property
+    def max_catch_up(self):
+        return self._max_catch_up
+
+    @property
+    def resync_threshold(self):
+        return self._resync_threshold
+
+    def pacer(self, name, period):
+        return Pacer(self, name, period)
@@ -0,0 +1,80 @@
+import ctypes
+
+import numpy
+
+# maximum sample value of the signed 16-bit PCM
+_SAMPLE_MAX = 32767
+
+
+class GainStage:
+    def __init__(self, samples_per_frame, channels, frame_period, *, ramp_time=0.1, limiter_threshold=0.9):
+        self._gain = 1.0
+        self._target = 1.0
+        # largest gain change per frame, unity change takes ramp_time seconds
+        self._max_step = frame_period / ramp_time
+
+        # all the buffers are preallocated, nothing is allocated while processing the frames
+        shape = (samples_per_frame, channels)
+        self._ramp = numpy.linspace(0, 1, samples_per_frame + 1, dtype=numpy.float32)[1:].reshape(-1, 1)
+        self._gains = numpy.empty((samples_per_frame, 1), dtype=numpy.float32)
+        self._buffer = numpy.empty(shape, dtype=numpy.float32)
+        self._scratch = (numpy.empty(shape, dtype=numpy.float32), numpy.empty(shape, dtype=numpy.float32))
+        # ctypes array is used as the output, so it can be passed to the opus encoder without a copy
+        self._output = (ctypes.c_char * (samples_per_frame * channels * 2))()
+        self._output_bytes = memoryview(self._output).cast('B')
+        self._output_view = numpy.frombuffer(self._output, dtype=numpy.int16).reshape(shape)
+
+        self._threshold = limiter_threshold * _SAMPLE_MAX
+        self._knee = _SAMPLE_MAX - self._threshold
+
+    @property
+    def gain(self):
+        return self._target
+
+    @gain.setter
+    def gain(self, value):
+        self._target = value
+
+    @property
+    def unity(self):
+        # true if the frames are not being altered at all
+        return self._gain == self._target == 1.0
+
+    def process(self, data):
+        # unity gain does not need any processing, the frame is only copied to the output buffer
+        if self.unity:
+            self._output_bytes[:] = data
+            return self._output
+
+        frame = numpy.frombuffer(data, dtype=numpy.int16).reshape(self._buffer.shape)
+        if self._gain != self._target:
+            # ramp the gain linearly within the frame to avoid zipper noise
+            step = min(max(self._target - self._gain, -self._max_step), self._max_step)
+            numpy.multiply(self._ramp, step, out=self._gains)
+            self._gains += self._gain
+            numpy.multiply(frame, self._gains, out=self._buffer)
+            peak_gain = max(self._gain, self._gain + step)
+            self._gain = self._target if step == self._target - self._gain else self._gain + step
+        else:
+            numpy.multiply(frame, self._gain, out=self._buffer)
+            peak_gain = self._gain
+
+        # only amplified signal can clip, it is limited softly instead
+        if peak_gain > 1.0 and max(self._buffer.max(), -self._buffer.min()) > self._threshold:
+            self._limit()
+
+        numpy.copyto(self._output_view, self._buffer, casting='unsafe')
+        return self._output
+
+    def _limit(self):
+        magnitude, excess = self._scratch
+        numpy.abs(self._buffer, out=magnitude)
+        # part of the signal over the threshold is compressed into the remaining headroom
+        numpy.subtract(magnitude, self._threshold, out=excess)
+        numpy.maximum(excess, 0, out=excess)
+        magnitude -= excess
+        excess *= 1 / self._knee
+        numpy.tanh(excess, out=excess)
+        excess *= self._knee
+        magnitude += excess
+        numpy.copysign(magnitude, self._buffer, out=self._buffer)
@@ -23,6 +23,11 @@ class Bot:
         'Please note that you\'ll need an access to the server to re-launch the bot. Good for doing a maintenance, '
         'for example updating the bot or changing bot\'s configuration.',
 
+        'stats': '* Shows the playback statistics\n\n'
+        'Reports the problems of the audio path since the bot was started, such as the frames sent late or '
+        'dropped, buffer underruns, the opus encoder load and the direct stream clients stalled or kicked. Useful '
+        'for diagnosing choppy audio.',
+
         'status': 'Reprints the status message\n\n'
         'Reprints the status message if it has been pushed up by other messages.',
 
@@ -71,6 +76,11 @@ class Bot:
     async def status(self):
         await self._bot.player.reprint_status()
 
+    @privileged
+    @bot.command(ignore_extra=False, help=_help_messages['stats'])
+    async def stats(self):
+        await self._bot.message(self._bot.player.playback_stats())
+
     @privileged
     @bot.command(ignore_extra=False, help=_help_messages['stop'])
     async def stop(self):
@@ -7,15 +7,17 @@ class Others:
         self._bot = bot
 
         # prepare direct stream info message
-        ds_message = 'Playlist link: {}\nDirect link: `{}`\n\nPlease note that these links will expire in a few ' \
-                     'minutes. Also, you can only be connected from a single location, including a discord voice ' \
-                     'channel.'
+        ds_message = 'Playlist link: {}\nDirect link: `{}`\n'.format(bot.stream.playlist_url, bot.stream.stream_url)
+        for path, url in bot.stream.rendition_urls.items():
+            ds_message += 'Direct link ({}): `{}`\n'.format(path, url)
+        ds_message += '\nPlease note that these links will expire in a few minutes. Also, you can only be connected ' \
+                      'from a single location, including a discord voice channel.'
         if self._bot.direct is not None:
             ds_message += ' If you are connected already, your previous connection will be terminated.'
         else:
             ds_message += ' If you are in the voice channel already, please disconnect before proceeding.'
 
-        self._direct_stream_message = ds_message.format(bot.stream.playlist_url, bot.stream.stream_url)
+        self._direct_stream_message = ds_message
 
     _help_messages = {
         'direct': 'Requests a link to the direct audio stream\n\n'
@@ -39,7 +41,7 @@ class Others:
     @dec.command(pass_context=True, ignore_extra=False, aliases=['d'], help=_help_messages['direct'])
     async def direct(self, ctx):
         token = await self._bot.users.generate_token(int(ctx.message.author.id))
-        await self._bot.whisper(self._direct_stream_message.format(token, token))
+        await self._bot.whisper(self._direct_stream_message.format(token=token))
 
     @dec.command(pass_context=True, ignore_extra=False, aliases=['j'], help=_help_messages['join'])
     async def join(self, ctx):
@@ -8,7 +8,8 @@ class Playlist:
     """Playlist manipulation, switching, listing playlists and their content"""
     def __init__(self, bot):
         self._bot = bot
-        self._db = database.playlist.PlaylistInterface(bot.loop, bot.config['ddmbot'])
+        self._db = database.playlist.PlaylistInterface(bot.loop, bot.config['ddmbot'],
+                                                       bot.scheduling.extraction_executor)
 
     _help_messages = {
         'group': 'Playlist manipulation, switching, listing playlists and their content\n\n'
@@ -129,6 +130,7 @@ class Playlist:
         reply = '**New playlist with the name** {} **was created**'.format(playlist_name)
         if set_active:
             await self._db.set_active(int(ctx.message.author.id), playlist_name)
+            await self._bot.player.playlist_changed(int(ctx.message.author.id))
             reply += '\nYour active playlist was switched to the newly created one.'
         await self._bot.whisper(reply)
 
@@ -142,11 +144,13 @@ class Playlist:
 
     async def _clear(self, user_id, playlist_name=None):
         playlist_name = await self._db.clear(user_id, playlist_name)
+        await self._bot.player.playlist_changed(user_id)
         await self._bot.whisper('**Playlist** {} **was cleared**'.format(playlist_name))
 
     @playlist.command(pass_context=True, ignore_extra=False, help=_help_messages['delete'])
     async def delete(self, ctx, playlist_name: str):
         await self._db.delete(int(ctx.message.author.id), playlist_name)
+        await self._bot.player.playlist_changed(int(ctx.message.author.id))
         await self._bot.whisper('**Playlist** {} **was removed**'.format(playlist_name))
 
     @playlist.command(pass_context=True, ignore_extra=False, aliases=['l'], help=_help_messages['list'])
@@ -199,6 +203,7 @@ class Playlist:
 
     async def _pop(self, user_id, *, count=1, playlist_name=None):
         playlist_name, real_count = await self._db.pop(user_id, count, playlist_name)
+        await self._bot.player.playlist_changed(user_id)
 
         reply = '**{} song(s) removed from playlist {}**'.format(real_count, playlist_name)
         if real_count < count:
@@ -215,6 +220,7 @@ class Playlist:
 
     async def _popid(self, user_id, song_id, playlist_name=None):
         playlist_name = await self._db.pop_id(user_id, song_id, playlist_name)
+        await self._bot.player.playlist_changed(user_id)
         await self._bot.whisper('**Song [{}] was removed from playlist {}**'.format(song_id, playlist_name))
 
     @playlist.command(pass_context=True, ignore_extra=False, aliases=['ps'], help=_help_messages['prepend'])
@@ -255,6 +261,7 @@ class Playlist:
     @playlist.command(pass_context=True, ignore_extra=False, aliases=['s'], help=_help_messages['select'])
     async def select(self, ctx, playlist_name: str):
         await self._db.set_active(int(ctx.message.author.id), playlist_name)
+        await self._bot.player.playlist_changed(int(ctx.message.author.id))
         await self._bot.whisper('**Playlist** {} **was set as active**'.format(playlist_name))
 
     @playlist.command(pass_context=True, ignore_extra=False, help=_help_messages['shuffle'])
@@ -267,6 +274,7 @@ class Playlist:
 
     async def _shuffle(self, user_id, playlist_name=None):
         playlist_name = await self._db.shuffle(user_id, playlist_name)
+        await self._bot.player.playlist_changed(user_id)
         await self._bot.whisper('**Playlist** {} **was shuffled**'.format(playlist_name))
 
     async def _insert(self, user_id, uris, playlist_name=None, prepend=False):
@@ -276,6 +284,7 @@ class Playlist:
         # now do the operation
         playlist_name, inserted, failed, truncated, messages = await self._db.insert(user_id, playlist_name, prepend,
                                                                                      uris)
+        await self._bot.player.playlist_changed(user_id)
 
         reply = '**{} song(s) inserted to** {}\n{} insertion(s) failed'.format(inserted, playlist_name, failed)
         if messages:
@@ -70,12 +70,14 @@ class Song:
     @song.command(ignore_extra=False, help=_help_messages['blacklist'])
     async def blacklist(self, song_id: int):
         await self._db.blacklist(song_id)
+        await self._bot.player.song_changed(song_id)
         await self._bot.message('Song [{}] has been blacklisted'.format(song_id))
 
     @privileged
     @song.command(ignore_extra=False, help=_help_messages['deduplicate'])
     async def deduplicate(self, which_id: int, target_id: int):
         await self._db.merge(which_id, target_id)
+        await self._bot.player.song_changed(which_id)
         await self._bot.message('Song [{}] has been marked as a duplicate of the song [{}]'.format(which_id, target_id))
 
     @song.group(ignore_extra=False, invoke_without_command=True)
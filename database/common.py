@@ -49,6 +49,15 @@ class Song(DdmBotSchema):
     duplicate = peewee.ForeignKeyField('self', null=True)
 
 
+# Loudness measured for the songs played, used for the normalization
+class Loudness(DdmBotSchema):
+    song = peewee.ForeignKeyField(Song, primary_key=True)
+
+    # integrated loudness [LUFS] and true peak [dBFS] as measured by ebur128 filter
+    integrated = peewee.FloatField()
+    peak = peewee.FloatField()
+
+
 # we will need this to resolve a foreign key loop
 DeferredUser = peewee.DeferredRelation()
 DeferredLink = peewee.DeferredRelation()
@@ -108,10 +117,11 @@ class ForeignKeyCheckModel(DdmBotSchema):
 
 
 class DBInterface:
-    def __init__(self, loop):
+    def __init__(self, loop, extraction_executor=None):
         if _database.is_closed():
             raise RuntimeError('Database must be initialized and opened before instantiating interfaces')
         self._loop = loop
+        self._extraction_executor = extraction_executor
         self._database = _database
 
 
@@ -124,6 +134,15 @@ def in_executor(method):
     return wrapped_method
 
 
+# decorator for DBInterface methods extracting the song information, these run in a separate executor
+def in_extraction_executor(method):
+    def wrapped_method(self, *args, **kwargs):
+        func = functools.partial(method, self, *args, **kwargs)
+        return self._loop.run_in_executor(self._extraction_executor, func)
+
+    return wrapped_method
+
+
 class DBSongUtil:
     # some class (static) constant variables
     _yt_regex = re.compile(r'^(https?://)?(www\.)?youtu(\.be/|be.com/.+?[?&]v=)(?P<id>[a-zA-Z0-9_-]+)')
@@ -211,7 +230,7 @@ def initialize(filename):
 
         _database.init(filename)
         _database.connect()
-        _database.create_tables([CreditTimestamp, Song, Playlist, Link, User], safe=True)
+        _database.create_tables([CreditTimestamp, Song, Loudness, Playlist, Link, User], safe=True)
 
         # check for the failed foreign key constrains
         failed_query = ForeignKeyCheckModel.raw('PRAGMA foreign_key_check;')
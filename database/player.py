@@ -19,14 +19,18 @@ class UnavailableSongError(Exception):
 
 
 class SongContext:
-    __slots__ = ['_dj', '_song', '_title', '_duration', '_url', '_skip_voters', '_all_listeners', '_current_listeners']
+    __slots__ = ['_dj', '_song', '_uuri', '_title', '_duration', '_url', '_codec', '_loudness', '_skip_voters',
+                 '_all_listeners', '_current_listeners']
 
-    def __init__(self, user_id, song_id, title, duration, url):
+    def __init__(self, user_id, song_id, uuri, title, duration, url, codec=None, loudness=None):
         self._dj = user_id
         self._song = song_id
+        self._uuri = uuri
         self._title = title
         self._duration = duration
         self._url = url
+        self._codec = codec
+        self._loudness = loudness
 
         self._skip_voters = set()
         self._all_listeners = set()
@@ -40,6 +44,10 @@ class SongContext:
     def dj_id(self):
         return self._dj
 
+    @property
+    def song_uuri(self):
+        return self._uuri
+
     @property
     def song_title(self):
         return self._title
@@ -52,6 +60,14 @@ class SongContext:
     def song_url(self):
         return self._url
 
+    @property
+    def song_codec(self):
+        return self._codec
+
+    @property
+    def song_loudness(self):
+        return self._loudness
+
     @property
     def listeners(self):
         return self._all_listeners
@@ -62,6 +78,10 @@ class SongContext:
     def get_final_sets(self):
         return self._all_listeners, self._skip_voters
 
+    def set_source(self, url, codec=None):
+        self._url = url
+        self._codec = codec
+
     def update_listeners(self, listeners):
         self._all_listeners = self._all_listeners | listeners
         self._current_listeners = listeners
@@ -74,15 +94,17 @@ class SongContext:
 
 
 class PlayerInterface(DBInterface, DBSongUtil):
-    def __init__(self, loop, config):
+    def __init__(self, loop, config, extraction_executor=None, cache=None):
+        self._cache = cache
         self._config_ap_threshold = int(config['ap_threshold'])
         self._config_ap_ratio = float(config['ap_skip_ratio'])
         self._config_max_duration = int(config['song_length_limit'])
         self._config_op_interval = int(config['op_interval'])
-        DBInterface.__init__(self, loop)
+        DBInterface.__init__(self, loop, extraction_executor)
 
+    # songs about to be played are resolved on the default executor, the transition must not wait for niced threads
     @in_executor
-    def get_next_song(self, user_id):
+    def get_next_song(self, user_id, prefetched=None):
         song = None
         with self._database.atomic():
             # check if there is an associated playlist
@@ -117,39 +139,46 @@ class PlayerInterface(DBInterface, DBSongUtil):
                 song = song.duplicate
 
         # check the constrains
-        # -- blacklist
-        if song.is_blacklisted:
-            raise RuntimeError('Song [{}] was blacklisted by an operator'.format(song.id))
-        # -- last played
-        time_diff = datetime.now() - song.last_played
-        if time_diff.total_seconds() < self._config_op_interval:
-            raise RuntimeError('Song [{}] has been played recently'.format(song.id))
-        # -- credits remaining
-        if song.credit_count == 0:
-            raise RuntimeError('Song [{}] is overplayed'.format(song.id))
-        # -- check the song length
-        if song.duration > self._config_max_duration:
-            raise RuntimeError('Song [{}]\'s length exceeds the limit'.format(song.id))
+        self._check_song(song)
+
+        # prefetched song context can be used only if the prediction was right
+        if prefetched is not None and prefetched.dj_id == user_id and prefetched.song_id == song.id:
+            log.debug('Using prefetched URL for the song [{}]'.format(song.id))
+            return prefetched
 
         # fetch the URL using youtube_dl
+        return SongContext(user_id, song.id, song.uuri, song.title, song.duration, *self._get_source(song),
+                           self._get_loudness(song.id))
+
+    @in_extraction_executor
+    def peek_next_song(self, user_id):
+        # read-only counterpart of get_next_song used to prepare the next song in advance
+        # no flags are changed here, the failures will be handled properly once the song is actually requested
         try:
-            result = self._ytdl.extract_info(self._make_url(song.uuri), download=False)
-        except youtube_dl.DownloadError as e:  # blacklist the song and raise an exception
-            if not song.has_failed:
-                log.warning('Download of the song [{}] failed'.format(song.id), exc_info=True)
-                Song.update(has_failed=True).where(Song.id == song.id).execute()
-            raise UnavailableSongError('Download of the song [{}] failed'.format(song.id), song_id=song.id,
-                                       song_title=song.title) from e
+            playlist = Playlist.select(Playlist.head).join(User, on=(User.active_playlist == Playlist.id)) \
+                .where(User.id == user_id).get()
+        except Playlist.DoesNotExist:
+            return None
+        if playlist.head is None:
+            return None
 
-        # there is a chance song was marked as failed before but it no longer applies, fix the flag
-        if song.has_failed:
-            log.info('Failed flag was removed from the song [{}] after a successful download'.format(song.id))
-            Song.update(has_failed=False).where(Song.id == song.id).execute()
+        song = Link.select(Link, Song).join(Song).where(Link.id == playlist.head).get().song
+        if song.duplicate_id is not None:
+            song = song.duplicate
 
-        return SongContext(user_id, song.id, song.title, song.duration, result['url'])
+        try:
+            self._check_song(song)
+            source = self._get_cached_source(song)
+            if source is None:
+                result = self._ytdl.extract_info(self._make_url(song.uuri), download=False)
+                source = result['url'], result.get('acodec')
+        except (RuntimeError, youtube_dl.DownloadError):
+            return None
+        return SongContext(user_id, song.id, song.uuri, song.title, song.duration, *source,
+                           self._get_loudness(song.id))
 
     @in_executor
-    def get_autoplaylist_song(self):
+    def get_autoplaylist_song(self, *, exclude=None, prefetched=None):
         reference_time = datetime.now() - timedelta(seconds=self._config_op_interval)
         query = Song.select(Song).where(
             Song.last_played < reference_time,  # overplay protection interval
@@ -160,22 +189,31 @@ class PlayerInterface(DBInterface, DBSongUtil):
             ~Song.is_blacklisted,  # cannot be blacklisted
             ~Song.has_failed,  # probably unavailable
             Song.duplicate >> None  # not fair + outdated information
-        ).order_by(peewee.fn.Random())
+        )
+        # song being played right now has not been updated yet, it must be excluded explicitly
+        if exclude is not None:
+            query = query.where(Song.id != exclude)
+
+        # prefetched song is used if it still conforms to the automatic playlist conditions
+        if prefetched is not None and prefetched.dj_id is None and prefetched.song_id != exclude:
+            if query.where(Song.id == prefetched.song_id).exists():
+                log.debug('Using prefetched URL for the song [{}]'.format(prefetched.song_id))
+                return prefetched
 
         try:
-            song = query.get()
+            song = query.order_by(peewee.fn.Random()).get()
         except Song.DoesNotExist:
             # there is no song conforming to the automatic playlist conditions
             return None
 
-        try:
-            result = self._ytdl.extract_info(self._make_url(song.uuri), download=False)
-        except youtube_dl.DownloadError as e:  # blacklist the song and raise an exception
-            log.warning('Download of the song [{}] failed'.format(song.id), exc_info=True)
-            Song.update(has_failed=True).where(Song.id == song.id).execute()
-            raise UnavailableSongError('Download of the song [{}] failed'.format(song.id), song_id=song.id,
-                                       song_title=song.title) from e
-        return SongContext(None, song.id, song.title, song.duration, result['url'])
+        return SongContext(None, song.id, song.uuri, song.title, song.duration, *self._get_source(song),
+                           self._get_loudness(song.id))
+
+    @in_executor
+    def refresh_source(self, song_ctx: SongContext):
+        # cached file of the song might have been evicted since the source was obtained, it is looked up again
+        song = Song.get(Song.id == song_ctx.song_id)
+        song_ctx.set_source(*self._get_source(song))
 
     @in_executor
     def update_stats(self, song_ctx: SongContext):
@@ -198,3 +236,62 @@ class PlayerInterface(DBInterface, DBSongUtil):
             song_query.execute()
             dj_query.execute()
             listener_query.execute()
+
+    @in_executor
+    def set_loudness(self, song_id, integrated, peak):
+        Loudness.insert(song=song_id, integrated=integrated, peak=peak).upsert().execute()
+
+    @in_executor
+    def flag_failed(self, song_id):
+        # the source was obtained, but the song could not be played completely
+        Song.update(has_failed=True).where(Song.id == song_id).execute()
+
+    @staticmethod
+    def _get_loudness(song_id):
+        try:
+            loudness = Loudness.get(Loudness.song == song_id)
+        except Loudness.DoesNotExist:
+            return None
+        return loudness.integrated, loudness.peak
+
+    def _check_song(self, song):
+        # -- blacklist
+        if song.is_blacklisted:
+            raise RuntimeError('Song [{}] was blacklisted by an operator'.format(song.id))
+        # -- last played
+        time_diff = datetime.now() - song.last_played
+        if time_diff.total_seconds() < self._config_op_interval:
+            raise RuntimeError('Song [{}] has been played recently'.format(song.id))
+        # -- credits remaining
+        if song.credit_count == 0:
+            raise RuntimeError('Song [{}] is overplayed'.format(song.id))
+        # -- check the song length
+        if song.duration > self._config_max_duration:
+            raise RuntimeError('Song [{}]\'s length exceeds the limit'.format(song.id))
+
+    def _get_cached_source(self, song):
+        # cached songs are played from the local copy, they do not depend on the remote side at all
+        if self._cache is None:
+            return None
+        return self._cache.lookup(song.uuri)
+
+    def _get_source(self, song):
+        # returns the URL and the audio codec of the song
+        source = self._get_cached_source(song)
+        if source is not None:
+            return source
+        try:
+            result = self._ytdl.extract_info(self._make_url(song.uuri), download=False)
+        except youtube_dl.DownloadError as e:  # blacklist the song and raise an exception
+            if not song.has_failed:
+                log.warning('Download of the song [{}] failed'.format(song.id), exc_info=True)
+                Song.update(has_failed=True).where(Song.id == song.id).execute()
+            raise UnavailableSongError('Download of the song [{}] failed'.format(song.id), song_id=song.id,
+                                       song_title=song.title) from e
+
+        # there is a chance song was marked as failed before but it no longer applies, fix the flag
+        if song.has_failed:
+            log.info('Failed flag was removed from the song [{}] after a successful download'.format(song.id))
+            Song.update(has_failed=False).where(Song.id == song.id).execute()
+
+        return result['url'], result.get('acodec')
@@ -82,11 +82,11 @@ class SongUriProcessor(DBSongUtil):
 
 
 class PlaylistInterface(DBInterface, DBPlaylistUtil):
-    def __init__(self, loop, config):
+    def __init__(self, loop, config, extraction_executor=None):
         self._config_max_playlists = int(config['playlist_count_limit'])
         self._config_max_songs = int(config['song_count_limit'])
         self._config_op_credit_cap = int(config['op_credit_cap'])
-        DBInterface.__init__(self, loop)
+        DBInterface.__init__(self, loop, extraction_executor)
 
     @in_executor
     def exists(self, user_id, playlist_name):
@@ -198,7 +198,7 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
 
         return playlist.name
 
-    @in_executor
+    @in_extraction_executor
     def insert(self, user_id, playlist_name, prepend, uris):
         # we will return a log of messages
         messages = list()
@@ -1,9 +1,7 @@
 import argparse
 import asyncio
 import configparser
-import errno
 import logging
-import os
 import time
 from aiohttp.errors import DisconnectedError
 from contextlib import suppress
@@ -13,11 +11,13 @@ from websockets.exceptions import InvalidState
 import discord
 import discord.ext.commands as dec
 
+import audioclock
 import commandhandler
 import database.bot
 import database.common
 import helpformatter
 import player
+import scheduling
 import streamserver
 import usermanager
 
@@ -31,15 +31,6 @@ if not discord.opus.is_loaded():
     discord.opus.load_opus('opus')
 
 
-# helper function to take care of named pipe creation
-def create_pipe(pipe_path):
-    try:
-        os.mkfifo(pipe_path, mode=0o600)
-    except OSError as e:
-        if not e.errno == errno.EEXIST:
-            raise
-
-
 #
 # Safe Voice Client to use as an placeholder before voice connection is created
 #
@@ -68,10 +59,10 @@ class DdmBot:
         self._config = configparser.ConfigParser(default_section='ddmbot')
         self._config.read(config_file)
 
-        # create named pipes (FIFOs)
-        create_pipe(self._config['ddmbot']['aac_pipe'])
-        create_pipe(self._config['ddmbot']['int_pipe'])
-        create_pipe(self._config['ddmbot']['pcm_pipe'])
+        # common clock used to pace the audio processing threads
+        self._clock = audioclock.AudioClock(self._config['ddmbot'])
+        # CPU and priority settings of the audio threads, ffmpeg processes and the metadata extraction
+        self._scheduling = scheduling.Scheduling(self._config['ddmbot'])
 
         # create event loop and a new client (bot)
         self._loop = asyncio.new_event_loop()
@@ -130,7 +121,8 @@ class DdmBot:
             self._loop.run_until_complete(self._client.login(self._config['discord']['token']))
 
             self._bot_task = asyncio.gather(self._database.task_credit_renew(), self._users.task_check_timeouts(),
-                                            self._player.task_player_fsm(), self._client.connect(), loop=self._loop)
+                                            self._player.task_player_fsm(), self._player.task_loudness_analysis(),
+                                            self._client.connect(), loop=self._loop)
 
             try:
                 self._loop.run_until_complete(self._bot_task)
@@ -149,6 +141,7 @@ class DdmBot:
             self._loop.run_until_complete(self._client.logout())
             self._loop.run_until_complete(self._player.cleanup())
             self._loop.run_until_complete(self._stream.cleanup())
+            self._scheduling.shutdown()
 
             pending = asyncio.Task.all_tasks()
             for task in pending:
@@ -285,6 +278,14 @@ class DdmBot:
     def loop(self):
         return self._loop
 
+    @property
+    def clock(self):
+        return self._clock
+
+    @property
+    def scheduling(self):
+        return self._scheduling
+
     @property
     def client(self):
         return self._client
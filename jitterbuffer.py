@@ -0,0 +1,88 @@
+import logging
+from math import ceil
+
+# set up the logger
+log = logging.getLogger('ddmbot.jitterbuffer')
+
+
+class JitterBuffer:
+    # target level is lowered by one frame after this much time of playback without an underrun [seconds]
+    _decay_time = 10
+
+    def __init__(self, frame_period, min_delay, max_delay):
+        if min_delay < 0 or max_delay < min_delay:
+            raise ValueError('Provided jitter buffer delays are invalid')
+
+        self._frame_period = frame_period
+        self._min_target = max(1, ceil(min_delay / frame_period))
+        self._max_target = max(self._min_target, ceil(max_delay / frame_period))
+        self._decay_frames = ceil(self._decay_time / frame_period)
+
+        self._target = self._min_target
+        self._buffering = False
+        self._underrun = False  # false while prebuffering a new input, such waiting is not an underrun
+        self._waited_frames = 0
+        self._stable_frames = 0
+
+        self._underruns = 0
+        self._underrun_frames = 0
+        self._max_underrun_frames = 0
+
+    @property
+    def buffering(self):
+        return self._buffering
+
+    @property
+    def target(self):
+        # target fill level in seconds
+        return self._target * self._frame_period
+
+    @property
+    def underruns(self):
+        return self._underruns
+
+    @property
+    def underrun_time(self):
+        # total duration of all the underruns in seconds
+        return self._underrun_frames * self._frame_period
+
+    @property
+    def max_underrun_time(self):
+        return self._max_underrun_frames * self._frame_period
+
+    def start(self):
+        # new input is played once the target level is reached
+        self._buffering = True
+        self._underrun = False
+        self._waited_frames = 0
+
+    def underrun(self):
+        # input ran dry, more data will be buffered this time
+        self._buffering = True
+        self._underrun = True
+        self._waited_frames = 0
+        self._stable_frames = 0
+        self._underruns += 1
+        self._target = min(self._target * 2, self._max_target)
+
+    def ready(self, buffered_frames, eof):
+        # called every frame period while buffering, true once the playback may continue
+        if buffered_frames < self._target and not eof:
+            self._waited_frames += 1
+            return False
+
+        self._buffering = False
+        if self._underrun:
+            self._underrun_frames += self._waited_frames
+            self._max_underrun_frames = max(self._max_underrun_frames, self._waited_frames)
+            log.warning('JitterBuffer: Underrun resolved after {:.0f} ms, target level {:.0f} ms, {} underrun(s) so '
+                        'far'.format(self._waited_frames * self._frame_period * 1000, self.target * 1000,
+                                     self._underruns))
+        return True
+
+    def played(self):
+        # the target level slowly returns to the minimum while the input is stable
+        self._stable_frames += 1
+        if self._stable_frames >= self._decay_frames:
+            self._stable_frames = 0
+            self._target = max(self._target - 1, self._min_target)
@@ -0,0 +1,123 @@
+import collections
+import logging
+import os
+
+# set up the logger
+log = logging.getLogger('ddmbot.opusdemux')
+
+# frame sizes in samples (at 48 kHz) for each of the opus TOC configurations, see RFC 6716 section 3.1
+_SILK_FRAME_SIZES = (480, 960, 1920, 2880)
+_HYBRID_FRAME_SIZES = (480, 960)
+_CELT_FRAME_SIZES = (120, 240, 480, 960)
+
+
+def packet_samples(packet):
+    # number of samples per channel encoded in the opus packet, 0 if the packet is malformed
+    if not packet:
+        return 0
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        frame_size = _SILK_FRAME_SIZES[config & 3]
+    elif config < 16:
+        frame_size = _HYBRID_FRAME_SIZES[config & 1]
+    else:
+        frame_size = _CELT_FRAME_SIZES[config & 3]
+
+    code = toc & 3
+    if code == 0:
+        return frame_size
+    if code < 3:
+        return 2 * frame_size
+    return frame_size * (packet[1] & 0x3f) if len(packet) > 1 else 0
+
+
+class OggOpusDemuxer:
+    __slots__ = ['_fd', '_buffer', '_partial', '_packets', '_headers', '_valid', '_eof']
+
+    _capture_pattern = b'OggS'
+    _page_header_len = 27
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._buffer = bytearray()
+        self._partial = bytearray()  # packet continued on the next page
+        self._packets = collections.deque()
+        self._headers = 2  # identification and comment header packets are skipped
+        self._valid = True
+        self._eof = False
+
+    @property
+    def valid(self):
+        # false if the stream turned out not to be an opus stream
+        return self._valid
+
+    def read_packet(self):
+        # returns an opus audio packet, None if there is none available
+        if not self._packets and not self._eof:
+            self._fill()
+        if self._packets:
+            return self._packets.popleft()
+        return None
+
+    def _fill(self):
+        # the pipe is always drained, so the muxer is never blocked by the packets we are not interested in
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                self._eof = True
+                break
+            if self._valid:
+                self._buffer += data
+        if self._valid:
+            self._parse_pages()
+
+    def _parse_pages(self):
+        buffer = self._buffer
+        while len(buffer) >= self._page_header_len:
+            if buffer[:4] != self._capture_pattern:
+                # lost the page boundary, look for the next one
+                start = buffer.find(self._capture_pattern, 1)
+                log.warning('OggOpusDemuxer: Page boundary lost, {} bytes skipped'.format(
+                    len(buffer) if start < 0 else start))
+                self._partial.clear()
+                if start < 0:
+                    buffer.clear()
+                    return
+                del buffer[:start]
+                continue
+
+            segment_count = buffer[26]
+            offset = self._page_header_len + segment_count
+            if len(buffer) < offset:
+                return
+            lacing_values = buffer[self._page_header_len:offset]
+            if len(buffer) < offset + sum(lacing_values):
+                return
+
+            # packets are split into segments of 255 bytes, shorter segment terminates the packet
+            for lacing_value in lacing_values:
+                self._partial += buffer[offset:offset + lacing_value]
+                offset += lacing_value
+                if lacing_value < 255:
+                    self._packet(bytes(self._partial))
+                    self._partial.clear()
+            del buffer[:offset]
+
+    def _packet(self, packet):
+        if not self._headers:
+            # a new stream is started if the decoder was restarted, its headers are skipped as well
+            if packet.startswith(b'OpusHead'):
+                self._headers = 1
+            else:
+                self._packets.append(packet)
+            return
+        if self._headers == 2 and not packet.startswith(b'OpusHead'):
+            log.warning('OggOpusDemuxer: Input is not an opus stream')
+            self._valid = False
+            self._buffer.clear()
+            return
+        self._headers -= 1
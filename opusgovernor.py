@@ -0,0 +1,87 @@
+import logging
+
+import discord.opus
+
+# set up the logger
+log = logging.getLogger('ddmbot.opusgovernor')
+
+# opus_encoder_ctl request not exposed by discord.py, extracted from opus API headers
+_CTL_SET_COMPLEXITY = 4010
+_MAX_COMPLEXITY = 10
+
+
+def _set_complexity(encoder, complexity):
+    ret = discord.opus._lib.opus_encoder_ctl(encoder._state, _CTL_SET_COMPLEXITY, complexity)
+    if ret < 0:
+        raise discord.opus.OpusError(ret)
+
+
+class ComplexityGovernor:
+    # encode time is averaged over this many frames before a decision is made
+    _window_frames = 50
+    # complexity is raised if the average encode time stays below this fraction of the budget ...
+    _raise_threshold = 0.5
+    # ... for this many consecutive windows
+    _raise_windows = 10
+
+    def __init__(self, frame_period, budget):
+        if budget < 0 or budget > 1:
+            raise ValueError('Provided encode budget is invalid')
+
+        self._budget = frame_period * budget  # 0 if the governor is disabled
+        self._complexity = _MAX_COMPLEXITY
+        self._encoder = None
+
+        self._frames = 0
+        self._total_time = 0.0
+        self._calm_windows = 0
+
+    @property
+    def complexity(self):
+        return self._complexity
+
+    def update(self, encoder, encode_time):
+        # called after every frame encoded, from the sending thread only
+        if not self._budget:
+            return
+        try:
+            if encoder is not self._encoder:
+                # new encoder is created with each voice connection, the current complexity is applied to it
+                self._encoder = encoder
+                self._reset()
+                _set_complexity(encoder, self._complexity)
+                return
+
+            self._frames += 1
+            self._total_time += encode_time
+            if self._frames < self._window_frames:
+                return
+            average = self._total_time / self._frames
+            self._frames = 0
+            self._total_time = 0.0
+
+            if average > self._budget:
+                self._calm_windows = 0
+                if self._complexity > 0:
+                    self._change(encoder, self._complexity - 1, average)
+            elif average < self._budget * self._raise_threshold and self._complexity < _MAX_COMPLEXITY:
+                self._calm_windows += 1
+                if self._calm_windows >= self._raise_windows:
+                    self._change(encoder, self._complexity + 1, average)
+            else:
+                self._calm_windows = 0
+        except discord.opus.OpusError:
+            log.exception('ComplexityGovernor: Cannot set the encoder complexity, governor disabled')
+            self._budget = 0
+
+    def _change(self, encoder, complexity, average):
+        _set_complexity(encoder, complexity)
+        log.warning('ComplexityGovernor: Encoder complexity changed from {} to {}, average encode time {:.2f} ms, '
+                    'budget {:.2f} ms'.format(self._complexity, complexity, average * 1000, self._budget * 1000))
+        self._complexity = complexity
+        self._reset()
+
+    def _reset(self):
+        self._frames = 0
+        self._total_time = 0.0
+        self._calm_windows = 0
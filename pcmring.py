@@ -0,0 +1,132 @@
+import threading
+
+
+class PcmRing:
+    def __init__(self, frame_len, frame_count):
+        if frame_count <= 1:
+            raise ValueError('PCM ring must be able to hold at least two frames')
+        self._frame_len = frame_len
+        self._capacity = frame_count
+        self._view = memoryview(bytearray(frame_len * frame_count))
+
+        self._written = 0  # total number of frames written, position of the writer
+        self._condition = threading.Condition()
+        self._readers = set()
+
+    @property
+    def frame_len(self):
+        return self._frame_len
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def written(self):
+        return self._written
+
+    @property
+    def readers(self):
+        return frozenset(self._readers)
+
+    def write(self, frame):
+        # writer never waits, readers falling behind are overrun instead
+        offset = (self._written % self._capacity) * self._frame_len
+        self._view[offset:offset + self._frame_len] = frame
+        with self._condition:
+            self._written += 1
+            self._condition.notify_all()
+
+    def reader(self, batch_frames):
+        reader = PcmRingReader(self, batch_frames)
+        with self._condition:
+            self._readers.add(reader)
+        return reader
+
+    def _remove_reader(self, reader):
+        with self._condition:
+            self._readers.discard(reader)
+            self._condition.notify_all()
+
+
+class PcmRingReader:
+    def __init__(self, ring, batch_frames):
+        self._ring = ring
+        self._batch_frames = min(batch_frames, ring.capacity // 2)
+        self._view = memoryview(bytearray(ring.frame_len * self._batch_frames))
+
+        self._position = ring.written
+        self._frames_read = 0
+        self._overruns = 0
+        self._dropped_frames = 0
+        self._closed = False
+
+    @property
+    def position(self):
+        return self._position
+
+    @property
+    def frame_len(self):
+        return self._ring.frame_len
+
+    @property
+    def capacity(self):
+        return self._ring.capacity
+
+    @property
+    def occupancy(self):
+        return min(self._ring.written - self._position, self._ring.capacity)
+
+    @property
+    def frames_read(self):
+        return self._frames_read
+
+    @property
+    def overruns(self):
+        return self._overruns
+
+    @property
+    def dropped_frames(self):
+        return self._dropped_frames
+
+    def close(self):
+        self._closed = True
+        self._ring._remove_reader(self)
+
+    def read(self, timeout=None):
+        # returns up to batch_frames frames, None on timeout or when closed
+        ring = self._ring
+        while True:
+            with ring._condition:
+                if not ring._condition.wait_for(lambda: self._closed or ring._written != self._position, timeout):
+                    return None
+                if self._closed:
+                    return None
+                lag = ring._written - self._position
+
+            # frames older than the ring capacity were overwritten already, skip to the middle of the ring
+            if lag > ring.capacity:
+                self._skip(lag - ring.capacity // 2)
+                continue
+
+            # copy as many contiguous frames as possible
+            index = self._position % ring.capacity
+            count = min(lag, self._batch_frames, ring.capacity - index)
+            length = count * ring.frame_len
+            offset = index * ring.frame_len
+            self._view[:length] = ring._view[offset:offset + length]
+
+            # writer might have been overwriting the frames while they were being copied
+            lag = ring._written - self._position
+            if lag >= ring.capacity:
+                self._skip(lag - ring.capacity // 2)
+                continue
+
+            self._position += count
+            self._frames_read += count
+            return self._view[:length]
+
+    def _skip(self, count):
+        self._overruns += 1
+        self._dropped_frames += count
+        self._position += count
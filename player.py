@@ -1,21 +1,32 @@
-import audioop
+import array
 import asyncio
+import collections
 import enum
 import errno
 import fcntl
 import functools
 import logging
 import os
+import re
 import shlex
+import signal
 import subprocess
+import termios
 import threading
 import time
 from contextlib import suppress
-from math import ceil
+from math import ceil, pi
 
 import discord.utils
+import numpy
 import youtube_dl
 
+import audiocache
+import audioprocessing
+import jitterbuffer
+import opusdemux
+import opusgovernor
+import supervisor
 from database.player import UnavailableSongError, PlayerInterface
 
 # set up the logger
@@ -26,140 +37,667 @@ FCNTL_F_LINUX_BASE = 1024
 FCNTL_F_SETPIPE_SZ = FCNTL_F_LINUX_BASE + 7
 
 
+class FrameRing:
+    __slots__ = ['_fd', '_frame_len', '_size', '_view', '_frame_view', '_start', '_length', '_eof', '_received',
+                 '_starving']
+
+    def __init__(self, fd, frame_len, frame_count):
+        self._fd = fd
+        self._frame_len = frame_len
+        self._size = frame_len * frame_count
+        self._view = memoryview(bytearray(self._size))
+        # frames crossing the ring boundary are assembled here
+        self._frame_view = memoryview(bytearray(frame_len))
+
+        self._start = 0  # position of the first byte buffered
+        self._length = 0  # number of bytes buffered
+        self._eof = False
+        self._received = 0  # total number of bytes read from the pipe
+        self._starving = False  # true if the last read or buffering check found no complete frame
+
+    @property
+    def eof(self):
+        # true once the writing end was closed, buffered frames might still be available though
+        return self._eof
+
+    def progress(self):
+        # used by the supervisor to detect a stalled decoder, may be called from other threads
+        return self._received, self._starving
+
+    def buffered(self):
+        # number of complete frames available without waiting, data still in the pipe are included
+        if not self._eof and self._length < self._size:
+            self._fill()
+        pending = array.array('i', [0])
+        fcntl.ioctl(self._fd, termios.FIONREAD, pending)
+        # consumer waiting for the input to be buffered is starving as well, the first frame might never come
+        self._starving = self._length + pending[0] < self._frame_len and not self._eof
+        return (self._length + pending[0]) // self._frame_len
+
+    def read(self):
+        # returns a frame, None if there is not enough data yet, b'' at the end of the input
+        if self._length < self._frame_len and not self._eof:
+            self._fill()
+        self._starving = self._length < self._frame_len and not self._eof
+        if self._length >= self._frame_len:
+            return self._take(self._frame_len)
+        if not self._eof:
+            return None
+        if self._length:
+            # the last frame is incomplete, this is the only case where padding is needed
+            log.debug('PcmProcessor: Data were padded with zeroes')
+            length = self._length
+            self._frame_view[:length] = self._take(length)
+            self._frame_view[length:] = bytes(self._frame_len - length)
+            return self._frame_view
+        return b''
+
+    def _fill(self):
+        # read as much data as possible using a single system call, free space may wrap around
+        end = self._start + self._length
+        if end >= self._size:
+            buffers = [self._view[end - self._size:self._start]]
+        else:
+            buffers = [self._view[end:], self._view[:self._start]]
+        try:
+            count = os.readv(self._fd, buffers)
+        except BlockingIOError:
+            return
+        if count == 0:
+            self._eof = True
+        self._length += count
+        self._received += count
+
+    def _take(self, length):
+        start = self._start
+        self._start = (start + length) % self._size
+        self._length -= length
+        if start + length <= self._size:
+            return self._view[start:start + length]
+        # frame is split by the ring boundary, it has to be copied
+        first_part = self._size - start
+        self._frame_view[:first_part] = self._view[start:]
+        self._frame_view[first_part:length] = self._view[:length - first_part]
+        return self._frame_view[:length]
+
+
+class Decoder:
+    __slots__ = ['_fd', '_ring', '_cache_uuri', '_song_context', '_packet_fd', '_demuxer', '_packet_lag',
+                 '_supervisor', '_start_task', '_loop']
+
+    # decoder output is read in chunks of up to this number of frames
+    _ring_frames = 25
+    # opus packets are copied from the input to an additional ogg output
+    _passthrough_output = '-vn -c:a copy -f ogg pipe:{}'
+    # time given to the process to exit on its own before it is killed [seconds]
+    _exit_timeout = 0.5
+
+    def __init__(self, loop, name, args, pipe_size, frame_len, *, song_context=None, cache_uuri=None,
+                 passthrough=False, restart_policy=supervisor.RestartPolicy.NEVER, stall_timeout=0,
+                 spawn_callback=None):
+        self._loop = loop
+        self._song_context = song_context  # None for the streams
+        self._cache_uuri = cache_uuri
+        self._packet_fd = None
+        self._demuxer = None
+        self._packet_lag = 0  # number of frames read without the corresponding packet consumed
+
+        # output pipes are created here, so they are read directly by the PCM thread and survive the restarts
+        self._fd, write_fd = os.pipe2(os.O_CLOEXEC)
+        fcntl.fcntl(self._fd, fcntl.F_SETFL, fcntl.fcntl(self._fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        try:
+            fcntl.fcntl(self._fd, FCNTL_F_SETPIPE_SZ, pipe_size)
+        except OSError as e:
+            os.close(self._fd)
+            os.close(write_fd)
+            if e.errno == errno.EPERM:
+                raise RuntimeError('Required PCM pipe size is over the system limit, see \'pcm_pipe_size\' in the '
+                                   'configuration file') from e
+            raise e
+        self._ring = FrameRing(self._fd, frame_len, self._ring_frames)
+
+        pass_fds = ()
+        if passthrough:
+            self._packet_fd, packet_write_fd = os.pipe2(os.O_CLOEXEC)
+            fcntl.fcntl(self._packet_fd, fcntl.F_SETFL, fcntl.fcntl(self._packet_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            args = args + shlex.split(self._passthrough_output.format(packet_write_fd))
+            pass_fds = (packet_write_fd,)
+            self._demuxer = opusdemux.OggOpusDemuxer(self._packet_fd)
+
+        # process is started asynchronously, if it fails, the output pipe is closed and the input simply ends
+        self._supervisor = supervisor.ProcessSupervisor(
+            loop, name, args, stdin=subprocess.DEVNULL, stdout=write_fd, pass_fds=pass_fds,
+            spawn_callback=spawn_callback, restart_policy=restart_policy, progress=self._ring.progress,
+            stall_timeout=stall_timeout)
+        self._start_task = loop.create_task(self._supervisor.start())
+
+    @property
+    def song_context(self):
+        return self._song_context
+
+    @property
+    def cache_uuri(self):
+        return self._cache_uuri
+
+    @property
+    def passthrough(self):
+        return self._demuxer is not None and self._demuxer.valid
+
+    @property
+    def returncode(self):
+        # exit status of the decoder, None if it is still running
+        return self._supervisor.returncode
+
+    @property
+    def eof(self):
+        return self._ring.eof
+
+    @property
+    def start_failed(self):
+        # process could not be spawned at all, the input ends right away without any exit status
+        return self._start_task.done() and not self._start_task.cancelled() and \
+            self._start_task.exception() is not None
+
+    async def stop(self):
+        try:
+            await self._start_task
+        except RuntimeError as e:
+            log.error('{}: {}'.format(self._supervisor.name, str(e)))
+        # the whole input might have been decoded already, e.g. if the song was faded out or the rest of it is in the
+        # pipe, such process is finishing the cache output and its exit status tells if the input was complete
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._supervisor.wait(), self._exit_timeout, loop=self._loop)
+        returncode = await self._supervisor.stop()
+
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._packet_fd is not None:
+            os.close(self._packet_fd)
+            self._packet_fd = None
+        return returncode
+
+    def suspend(self):
+        self._supervisor.send_signal(signal.SIGSTOP)
+
+    def resume(self):
+        self._supervisor.send_signal(signal.SIGCONT)
+
+    def buffered_frames(self):
+        return self._ring.buffered()
+
+    def read_frame(self):
+        return self._ring.read()
+
+    def read_packet(self):
+        # opus packet corresponding to the last frame read, None if not available
+        # packets are muxed in pages, so they might arrive later than the frames, such packets are skipped
+        if self._demuxer is None:
+            return None
+        self._packet_lag += 1
+        packet = None
+        while self._packet_lag:
+            packet = self._demuxer.read_packet()
+            if packet is None:
+                return None
+            self._packet_lag -= 1
+        return packet
+
+
+class VoiceSender(threading.Thread):
+    def __init__(self, bot, queue_length, encode_budget):
+        super().__init__()
+
+        self._bot = bot
+        encoder = bot.voice.encoder
+        self._samples_per_frame = encoder.samples_per_frame
+        self._frame_period = encoder.frame_length / 1000.0
+        self._gain_stage = audioprocessing.GainStage(encoder.samples_per_frame, encoder.channels, self._frame_period)
+        # encoder complexity is lowered if the encoding takes too much of the frame period
+        self._governor = opusgovernor.ComplexityGovernor(self._frame_period, encode_budget)
+
+        # oldest frames are dropped if the queue is full, the pacing thread never waits for the sender
+        self._queue = collections.deque(maxlen=max(1, ceil(queue_length / self._frame_period)))
+        self._condition = threading.Condition()
+        self._end = False
+
+        self._dropped_frames = 0
+        self._passthrough_frames = 0
+        self._encode_time = 0.0  # exponential moving average
+        self._max_encode_time = 0.0
+        self._latency = 0.0  # time between queuing and sending a frame, exponential moving average
+
+    @property
+    def volume(self):
+        return self._gain_stage.gain
+
+    @volume.setter
+    def volume(self, value):
+        self._gain_stage.gain = value
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    @property
+    def dropped_frames(self):
+        return self._dropped_frames
+
+    @property
+    def passthrough_frames(self):
+        return self._passthrough_frames
+
+    @property
+    def encode_time(self):
+        return self._encode_time
+
+    @property
+    def max_encode_time(self):
+        return self._max_encode_time
+
+    @property
+    def latency(self):
+        return self._latency
+
+    @property
+    def complexity(self):
+        return self._governor.complexity
+
+    def send(self, data, packet=None):
+        # the frame must be copied, decoder and mixing buffers are reused for the next frame
+        frame = bytes(data)
+        with self._condition:
+            if len(self._queue) == self._queue.maxlen:
+                self._dropped_frames += 1
+            self._queue.append((frame, packet, time.perf_counter()))
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._end = True
+            self._condition.notify()
+        self.join()
+
+    def run(self):
+        dropped_frames = 0  # to control log spam
+
+        self._bot.scheduling.setup_audio_thread('VoiceSender')
+
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._end or self._queue)
+                if self._end:
+                    return
+                frame, packet, queued = self._queue.popleft()
+
+            voice_client = self._bot.voice
+            if not voice_client.is_connected():
+                continue
+
+            # source packet can be sent as is if the frame would not be altered anyway
+            if packet is not None and self._gain_stage.unity and \
+                    opusdemux.packet_samples(packet) == self._samples_per_frame:
+                self._passthrough_frames += 1
+                data = packet
+            else:
+                # adjust the volume and encode the frame
+                start = time.perf_counter()
+                data = voice_client.encoder.encode(self._gain_stage.process(frame), self._samples_per_frame)
+                encode_time = time.perf_counter() - start
+                self._encode_time += (encode_time - self._encode_time) * 0.05
+                self._max_encode_time = max(self._max_encode_time, encode_time)
+                self._governor.update(voice_client.encoder, encode_time)
+
+            voice_client.play_audio(data, encode=False)
+            self._latency += (time.perf_counter() - queued - self._latency) * 0.05
+
+            if self._dropped_frames != dropped_frames:
+                dropped_frames = self._dropped_frames
+                log.warning('VoiceSender: Sending is not keeping up, {} frame(s) dropped so far, average encode time '
+                            '{:.2f} ms, maximum {:.2f} ms'.format(dropped_frames, self._encode_time * 1000,
+                                                                  self._max_encode_time * 1000))
+
+
 class PcmProcessor(threading.Thread):
-    def __init__(self, bot, next_callback):
+    # maximum delay applied to the voice channel to match the direct stream latency [seconds]
+    _max_compensation = 10
+    # compensation is adjusted by a single frame once in this many frames while the audio is being played
+    _compensation_step = 10
+
+    def __init__(self, bot, next_callback, release_callback):
         self._bot = bot
         config = bot.config['ddmbot']
 
-        pipe_size = int(config['pcm_pipe_size'])
-        if pipe_size > 2**31 or pipe_size <= 0:
-            raise ValueError('Provided \'pcm_pipe_size\' is invalid')
+        crossfade = float(config['crossfade'])
+        if crossfade < 0:
+            raise ValueError('Provided \'crossfade\' is invalid')
+
+        self._max_offset = None
+        if config['latency_max_offset']:
+            self._max_offset = float(config['latency_max_offset'])
+            if self._max_offset < 0:
+                raise ValueError('Provided \'latency_max_offset\' is invalid')
 
-        if not callable(next_callback):
-            raise TypeError('Next callback must be a callable object')
+        if not callable(next_callback) or not callable(release_callback):
+            raise TypeError('Next and release callbacks must be callable objects')
 
         super().__init__()
 
         # despite the fact we expect voice_client to change, encoder parameters should be static
         self._frame_len = bot.voice.encoder.frame_size
         self._frame_period = bot.voice.encoder.frame_length / 1000.0
-        self._volume = int(config['default_volume']) / 100
-
-        self._in_pipe_fd = os.open(config['pcm_pipe'], os.O_RDONLY | os.O_NONBLOCK)
-        self._out_pipe_fd = os.open(config['int_pipe'], os.O_WRONLY | os.O_NONBLOCK)
-
-        try:
-            fcntl.fcntl(self._in_pipe_fd, FCNTL_F_SETPIPE_SZ, pipe_size)
-        except OSError as e:
-            if e.errno == 1:
-                raise RuntimeError('Required PCM pipe size is over the system limit, see \'pcm_pipe_size\' in the '
-                                   'configuration file') from e
-            raise e
+        self._frame_shape = (bot.voice.encoder.samples_per_frame, bot.voice.encoder.channels)
+
+        # encoding and sending to discord is done by a separate thread, this one only takes care of the timing
+        self._sender = VoiceSender(bot, float(config['voice_queue_length']), float(config['opus_encode_budget']))
+        self.volume = int(config['default_volume']) / 100
+
+        self._pacer = bot.clock.pacer('PcmProcessor', self._frame_period)
+        self._jitter = jitterbuffer.JitterBuffer(self._frame_period, float(config['jitter_min_delay']),
+                                                 float(config['jitter_max_delay']))
+
+        # equal-power crossfade curves, one gain value per sample
+        self._fade_frames = ceil(crossfade / self._frame_period)
+        fade_len = self._fade_frames * self._frame_shape[0]
+        self._fade_in = numpy.sin(numpy.linspace(0, pi / 2, fade_len, dtype=numpy.float32)).reshape(-1, 1)
+        self._fade_out = numpy.cos(numpy.linspace(0, pi / 2, fade_len, dtype=numpy.float32)).reshape(-1, 1)
+        self._mix_buffer = numpy.empty(self._frame_shape, dtype=numpy.float32)
+        self._mix_scratch = numpy.empty(self._frame_shape, dtype=numpy.float32)
+        self._mix_output = numpy.empty(self._frame_shape, dtype=numpy.int16)
+        self._mix_output_view = memoryview(self._mix_output).cast('B')
+        self._zero_frame = bytes(self._frame_len)
+
+        # decoders are switched by the player, requests are processed by the thread itself
+        self._requests = collections.deque()
+        self._current = None
+        self._queued = None  # next input, started as soon as the current one ends
+        # false if the current input was started by the thread itself and the player did not take it over yet, such
+        # input is not played
+        self._adopted = True
+        self._position = 0
+        self._outgoing = None
+        self._fade_position = 0
+        self._fade_started = False
+
+        # voice frames are delayed to keep them in sync with the direct stream, None stands for a frame not sent
+        self._delay_line = collections.deque()
+        self._delay_audio = 0  # number of frames in the delay line to be sent
+        self._compensation = 0  # length of the delay line in frames
+        self._compensation_tick = 0
 
         self._next = next_callback
+        self._release = release_callback
         self._end = threading.Event()
 
     @property
     def volume(self):
-        return self._volume
+        return self._sender.volume
 
     @volume.setter
     def volume(self, value):
-        self._volume = min(max(value, 0.0), 2.0)
+        self._sender.volume = min(max(value, 0.0), 2.0)
+
+    @property
+    def late_frames(self):
+        return self._pacer.late_frames
+
+    @property
+    def resyncs(self):
+        return self._pacer.resyncs
+
+    @property
+    def sender(self):
+        return self._sender
+
+    @property
+    def jitter(self):
+        return self._jitter
+
+    @property
+    def voice_latency(self):
+        # time the audio spends in the bot before it is sent to the voice channel, compensation included
+        return self._sender.latency + self._compensation * self._frame_period
+
+    @property
+    def position(self):
+        # playback position of the current input in seconds
+        return self._position * self._frame_period
+
+    def attach(self, decoder):
+        # position is reset immediately so it does not refer to the previous input
+        if self._current is not decoder:
+            self._position = 0
+        self._requests.append(functools.partial(self._attach, decoder))
+
+    def queue(self, decoder):
+        self._requests.append(functools.partial(self._queue, decoder))
+
+    def unqueue(self, decoder):
+        self._requests.append(functools.partial(self._unqueue, decoder))
+
+    def park(self, decoder):
+        # decoder stops being read, but it is not released
+        self._requests.append(functools.partial(self._park, decoder))
+
+    def fade_out(self, decoder):
+        self._requests.append(functools.partial(self._start_fade_out, decoder))
+
+    def detach(self, decoder):
+        self._requests.append(functools.partial(self._detach, decoder))
 
     def stop(self):
         self._end.set()
         self.join()
-        self.flush()
-        os.close(self._in_pipe_fd)
-        os.close(self._out_pipe_fd)
+        self._sender.stop()
+
+    # requests referring to a decoder which is not in the expected slot are ignored, the decoder might have been
+    # switched by the thread itself in the meantime
+    def _attach(self, decoder):
+        if self._queued is decoder:
+            self._queued = None
+        if self._current is decoder:
+            self._adopted = True
+            return
+        if self._current is not None:
+            self._release(self._current)
+        self._current = decoder
+        self._adopted = True
+        self._position = 0
+        self._jitter.start()
+
+    def _queue(self, decoder):
+        if self._queued is not None and self._queued is not decoder:
+            self._release(self._queued)
+        self._queued = decoder
+
+    def _unqueue(self, decoder):
+        if self._queued is decoder:
+            self._release(self._queued)
+            self._queued = None
+        elif self._current is decoder and not self._adopted:
+            # the prediction turned out to be wrong after the input was started already
+            self._release(self._current)
+            self._current = None
+
+    def _park(self, decoder):
+        if self._current is decoder:
+            self._current = None
+
+    def _start_fade_out(self, decoder):
+        if self._current is not decoder:
+            return
+        if self._outgoing is not None:
+            self._release(self._outgoing)
+        self._outgoing = self._current
+        self._current = None
+        self._fade_position = 0
+        self._fade_started = False
+
+    def _detach(self, decoder):
+        if self._current is not decoder:
+            return
+        self._release(self._current)
+        self._current = None
+
+    def _mix_outgoing(self, data, data_len):
+        outgoing_data = self._outgoing.read_frame()
+        if outgoing_data and self._outgoing.passthrough:
+            # packets are not needed, but they must be consumed to keep the decoder going
+            self._outgoing.read_packet()
+        if outgoing_data is None:
+            outgoing_data = self._zero_frame
+        elif not outgoing_data:
+            # outgoing input is over, nothing to mix anymore
+            self._release(self._outgoing)
+            self._outgoing = None
+            return data, data_len
+
+        # fading starts once the next input delivers the data, but we won't wait forever
+        if not self._fade_started:
+            if not data_len and self._fade_position < self._fade_frames:
+                self._fade_position += 1
+                return outgoing_data, self._frame_len
+            self._fade_started = True
+            self._fade_position = 0
+
+        begin = self._fade_position * self._frame_shape[0]
+        end = begin + self._frame_shape[0]
+        numpy.multiply(numpy.frombuffer(outgoing_data, dtype=numpy.int16).reshape(self._frame_shape),
+                       self._fade_out[begin:end], out=self._mix_buffer)
+        if data_len:
+            numpy.multiply(numpy.frombuffer(data, dtype=numpy.int16).reshape(self._frame_shape),
+                           self._fade_in[begin:end], out=self._mix_scratch)
+            self._mix_buffer += self._mix_scratch
+
+        self._fade_position += 1
+        if self._fade_position == self._fade_frames:
+            self._release(self._outgoing)
+            self._outgoing = None
+
+        numpy.clip(self._mix_buffer, -32768, 32767, out=self._mix_buffer)
+        numpy.copyto(self._mix_output, self._mix_buffer, casting='unsafe')
+        return self._mix_output_view, self._frame_len
+
+    def _update_compensation(self):
+        target = 0
+        direct_latency = self._bot.stream.latency
+        if self._max_offset is not None and direct_latency is not None and self._bot.voice.is_connected():
+            difference = direct_latency - self._sender.latency - self._max_offset
+            target = min(max(0, ceil(difference / self._frame_period)), ceil(self._max_compensation /
+                                                                               self._frame_period))
+        if target == self._compensation:
+            return
 
-    def flush(self):
-        try:
-            os.read(self._in_pipe_fd, 1048576)
-        except OSError as e:
-            if e.errno != errno.EAGAIN:
-                raise
+        # the change cannot be heard if there is no audio in the delay line, otherwise it is done gradually
+        if not self._delay_audio:
+            self._compensation = target
+        else:
+            self._compensation_tick += 1
+            if self._compensation_tick < self._compensation_step:
+                return
+            self._compensation += 1 if target > self._compensation else -1
+        self._compensation_tick = 0
+
+    def _send_voice(self, data, packet):
+        # data is None if no frame is to be sent, such frames are kept in the delay line to retain the timing
+        if not self._compensation and not self._delay_line:
+            if data is not None:
+                self._sender.send(data, packet)
+            return
+
+        if data is not None:
+            # the frame must be copied, decoder and mixing buffers are reused for the next frame
+            data = bytes(data)
+            self._delay_audio += 1
+        self._delay_line.append((data, packet))
+        while len(self._delay_line) > self._compensation:
+            data, packet = self._delay_line.popleft()
+            if data is not None:
+                self._delay_audio -= 1
+                self._sender.send(data, packet)
+
+    def _read_current(self):
+        # returns a frame of the current input, None if there is nothing to play right now
+        while self._current is not None:
+            # input started by the thread itself keeps buffering silently until the player confirms the prediction
+            if not self._adopted:
+                return None
+            if self._jitter.buffering and not self._jitter.ready(self._current.buffered_frames(), self._current.eof):
+                return None
+
+            data = self._current.read_frame()
+            if data is None:
+                # the next song is allowed to take its time while the previous one is fading out
+                if self._outgoing is None:
+                    log.warning('PcmProcessor: Buffer underrun, target level {:.0f} ms'.format(
+                        self._jitter.target * 1000))
+                    self._jitter.underrun()
+                return None
+            if data:
+                self._position += 1
+                self._jitter.played()
+                return data
+
+            # if we read nothing, that means the input to the pipe is not connected anymore
+            self._release(self._current)
+            self._next(self._current)
+            # the next input is already decoding, it continues as soon as the player takes it over, or it is unqueued
+            # if the prediction turns out to be wrong, so a wrong song is never heard
+            self._current = self._queued
+            self._adopted = self._current is None
+            self._queued = None
+            self._position = 0
+            self._jitter.start()
+        return None
 
     def run(self):
-        loops = 0  # loop counter
-        next_called = True  # variable to prevent constant calling of self._next()
-        output_congestion = False  # to control log spam
-        buffering_cycles = 0
-        cycles_in_second = 1 // self._frame_period
-        zero_data = b'\0' * self._frame_len
-
-        # capture the starting time
-        start_time = time.clock_gettime(time.CLOCK_MONOTONIC_RAW)
+        zero_data = self._zero_frame
+
+        self._sender.start()
+        self._bot.scheduling.setup_audio_thread('PcmProcessor')
+
+        # start the clock
+        self._pacer.start()
         while not self._end.is_set():
-            # increment loop counter
-            loops += 1
             # set initial value for data length
             data_len = 0
-
-            # if it's not a buffering cycle read more data
-            if buffering_cycles:
-                buffering_cycles -= 1
-                data = zero_data
-            else:
-                try:
-                    data = os.read(self._in_pipe_fd, self._frame_len)
-                    data_len = len(data)
-
-                    if data_len:
-                        next_called = False
-
-                    if data_len != self._frame_len:
-                        if data_len == 0:
-                            # if we read nothing, that means the input to the pipe is not connected anymore
-                            if not next_called:
-                                next_called = True
-                                self._next()
-                            data = zero_data
-                        else:
-                            # if we read something, we are likely at the end of the input, pad with zeroes and log
-                            # TODO: is there a way to distinguish buffering issues and end of the input issues?
-                            log.debug('PcmProcessor: Data were padded with zeroes')
-                            data.ljust(self._frame_len, b'\0')
-
-                except OSError as e:
-                    if e.errno == errno.EAGAIN:
-                        data = zero_data
-                        log.warning('PcmProcessor: Buffer not ready, waiting one second')
-                        buffering_cycles = cycles_in_second
-                    else:
-                        raise
-
-            # now we try to pass data to the output, if connected, we also send the silence (zero_data)
-            if self._bot.stream.is_connected():
-                try:
-                    os.write(self._out_pipe_fd, data)
-                    # data sent successfully, clear the congestion flag
-                    output_congestion = False
-                except OSError as e:
-                    if e.errno == errno.EAGAIN:
-                        # prevent spamming the log with megabytes of text
-                        if not output_congestion:
-                            log.error('PcmProcessor: Output pipe not ready, dropping frame(s)')
-                            output_congestion = True
-                    else:
-                        raise
-            else:
-                # if we are not connected, there is no output congestion and the underlying buffer will be cleared
-                output_congestion = False
+            data = zero_data
+            packet = None
+
+            # process the input changes requested by the player
+            while self._requests:
+                self._requests.popleft()()
+
+            # read more data, unless the input is being buffered
+            current_data = self._read_current()
+            if current_data is not None:
+                data = current_data
+                data_len = self._frame_len
+                # opus packets are read in lockstep with the frames, even if they are not going to be used
+                if self._current.passthrough:
+                    packet = self._current.read_packet()
+
+            # mix in the input being faded out
+            if self._outgoing is not None:
+                data, data_len = self._mix_outgoing(data, data_len)
+                packet = None
+
+            # now we pass data to the stream server, if connected, the silence (zero_data) is sent only in between the
+            # frames of the program, otherwise the stream server serves the pre-encoded silence itself
+            program = data_len or self._current is not None
+            self._bot.stream.set_program(program)
+            if program and self._bot.stream.is_connected():
+                self._bot.stream.pcm_ring.write(data)
 
             # and last but not least, discord output, this time, we can (should) omit partial frames or zero data
-            voice_client = self._bot.voice
-            if voice_client.is_connected() and data_len == self._frame_len:
-                # adjust the volume
-                data = audioop.mul(data, 2, self._volume)
-                # call the callback
-                voice_client.play_audio(data)
+            self._update_compensation()
+            if self._bot.voice.is_connected() and data_len == self._frame_len:
+                self._send_voice(data, packet)
+            else:
+                self._send_voice(None, None)
 
-            # calculate next transmission time
-            next_time = start_time + self._frame_period * loops
-            sleep_time = max(0, self._frame_period + (next_time - time.clock_gettime(time.CLOCK_MONOTONIC_RAW)))
-            time.sleep(sleep_time)
+            # wait for the next transmission time
+            self._pacer.wait()
 
 
 class PlayerState(enum.Enum):
@@ -171,10 +709,31 @@ class PlayerState(enum.Enum):
 
 
 class Player:
+    # songs shorter than this many crossfades are not crossfaded, the transition would take most of them
+    _crossfade_min_ratio = 2
+    # maximum true peak allowed after the loudness normalization [dBFS]
+    _loudness_max_peak = -1.0
+    # smaller gain is not applied, so the opus passthrough is kept for the songs close to the target [dB]
+    _loudness_min_gain = 0.1
+    _loudness_regex = re.compile(r'I:\s+(-?\d+(?:\.\d+)?) LUFS')
+    _peak_regex = re.compile(r'Peak:\s+(-?\d+(?:\.\d+)?) dBFS')
+
     def __init__(self, bot):
         self._bot = bot
         self._config_skip_ratio = float(bot.config['ddmbot']['skip_ratio'])
         self._config_stream_end_transition = int(bot.config['ddmbot']['stream_end_transition'])
+        self._config_prefetch_time = int(bot.config['ddmbot']['prefetch_time'])
+        self._config_crossfade = float(bot.config['ddmbot']['crossfade'])
+        self._config_preload = bool(int(bot.config['ddmbot']['preload_next_song']))
+        self._config_passthrough = bool(int(bot.config['ddmbot']['opus_passthrough']))
+        self._config_idle_suspend = int(bot.config['ddmbot']['stream_idle_suspend'])
+        self._config_stall_timeout = float(bot.config['ddmbot']['decoder_stall_timeout'])
+        self._config_pipe_size = int(bot.config['ddmbot']['pcm_pipe_size'])
+        if self._config_pipe_size > 2**31 or self._config_pipe_size <= 0:
+            raise ValueError('Provided \'pcm_pipe_size\' is invalid')
+        self._config_loudness_target = None
+        if bot.config['ddmbot']['loudness_target']:
+            self._config_loudness_target = float(bot.config['ddmbot']['loudness_target'])
 
         # figure out initial state
         self._state = PlayerState.STOPPED
@@ -198,18 +757,45 @@ class Player:
         self._apply_cooldown = True
         self._song_context = None
         self._stream_url = None
+        self._stream_media_url = None
+        self._stream_codec = None
+        self._stream_live = False
+        self._stream_suspended = False
+        self._suspend_task = None
         self._stream_title = None
         self._status_message = None
-        self._ffmpeg = None
+        self._decoder = None
+        self._decoders = set()
+        self._decoder_failed = False  # the last decoder could not be started, the song was not played
+        self._crossfade_task = None
+
+        # next song prediction
+        self._song_start = None
+        self._prefetch_task = None
+        self._prefetched = None
+        self._preloaded = None  # (song context, decoder) of the predicted song
 
         # create PCM thread
-        self._pcm_thread = PcmProcessor(self._bot, self._playback_ended_callback)
-        self._ffmpeg_command = 'ffmpeg -reconnect 1 -reconnect_delay_max 3 -loglevel error' \
-                               ' -i {{}} -y -vn -f s16le -ar {} -ac {} {}'.format(bot.voice.encoder.sampling_rate,
-            bot.voice.encoder.channels, shlex.quote(bot.config['ddmbot']['pcm_pipe']))
+        self._pcm_thread = PcmProcessor(self._bot, self._input_ended_callback, self._release_decoder_callback)
+        self._ffmpeg_command = 'ffmpeg {{}} -loglevel error -i {{}} -y -vn {{}}-f s16le -ar {} -ac {} pipe:1'.format(
+            bot.voice.encoder.sampling_rate, bot.voice.encoder.channels)
+        self._ffmpeg_volume_filter = '-af volume={:.2f}dB '
+        self._ffmpeg_remote_options = '-reconnect 1 -reconnect_delay_max 3'
+        # compressed audio is stored in the cache as is, no transcoding is needed
+        self._ffmpeg_cache_output = ' -vn -c:a copy -f matroska {}'
+
+        # local audio cache, songs are stored there during the first playback
+        self._cache = audiocache.AudioCache(bot.config['ddmbot'])
+
+        # loudness analysis of the songs, each song is analyzed only once
+        self._loudness_command = 'ffmpeg {} -nostats -hide_banner -i {} -vn -af ebur128=peak=true -f null -'
+        self._loudness_queue = asyncio.Queue(loop=bot.loop)
+        self._loudness_queued = set()
+        self._loudness_pending = dict()  # maps song uuri -> song id for the songs being cached
 
         # database interface
-        self._database = PlayerInterface(bot.loop, bot.config['ddmbot'])
+        self._database = PlayerInterface(bot.loop, bot.config['ddmbot'], bot.scheduling.extraction_executor,
+                                         self._cache)
 
     #
     # Resource management wrappers
@@ -219,13 +805,12 @@ class Player:
         await self._transition_lock.acquire()
 
     async def cleanup(self):
-        if self._ffmpeg is not None and self._ffmpeg.poll() is None:
-            self._ffmpeg.kill()
-            self._ffmpeg.communicate()
-
         if self._pcm_thread is not None:
             self._pcm_thread.stop()
 
+        await asyncio.gather(*[self._stop_decoder(decoder) for decoder in self._decoders], loop=self._bot.loop)
+        self._decoders.clear()
+
     #
     # Properties reflecting the player's state
     #
@@ -341,6 +926,32 @@ class Player:
     def volume(self, value):
         self._pcm_thread.volume = value
 
+    def playback_stats(self):
+        # timing problems of the audio path since the start, formatted for the text channel
+        lines = ['**Playback statistics**', '**Clock:** {} late frame(s), {} resync(s)'.format(
+            self._pcm_thread.late_frames, self._pcm_thread.resyncs)]
+        jitter = self._pcm_thread.jitter
+        lines.append('**Jitter buffer:** {} underrun(s), {:.1f} s in total, longest {:.0f} ms, target level {:.0f} ms'
+                     .format(jitter.underruns, jitter.underrun_time, jitter.max_underrun_time * 1000,
+                             jitter.target * 1000))
+        sender = self._pcm_thread.sender
+        lines.append('**Voice sending:** {} dropped frame(s), {} passthrough frame(s), {} frame(s) queued, latency '
+                     '{:.0f} ms'.format(sender.dropped_frames, sender.passthrough_frames, sender.queue_depth,
+                                        sender.latency * 1000))
+        lines.append('**Opus encoder:** complexity {}, encode time {:.2f} ms, maximum {:.2f} ms'.format(
+            sender.complexity, sender.encode_time * 1000, sender.max_encode_time * 1000))
+        for path, late_frames, resyncs in self._bot.stream.clock_stats:
+            lines.append('**Direct stream clock** ({})**:** {} late frame(s), {} resync(s)'.format(
+                path, late_frames, resyncs))
+        close_reasons = self._bot.stream.close_reasons
+        lines.append('**Direct stream clients:** {} stall(s), closed connections: {}'.format(
+            self._bot.stream.stalls, ', '.join('{} {}'.format(count, reason) for reason, count in close_reasons.items())
+            if close_reasons else 'none'))
+        for path, occupancy, capacity, overruns, dropped_frames in self._bot.stream.ring_stats:
+            lines.append('**Direct stream PCM ring** ({})**:** occupancy {}/{}, {} overrun(s), {} dropped frame(s)'
+                         .format(path, occupancy, capacity, overruns, dropped_frames))
+        return '\n'.join(lines)
+
     #
     # Status message reprint API
     #
@@ -378,12 +989,42 @@ class Player:
                 if self.cooldown:
                     self._switch_state.set()
                     return
+            # stream is suspended after a while if nobody is listening
+            if self.streaming:
+                if listeners:
+                    await self._cancel_suspend()
+                    if self._stream_suspended:
+                        await self._resume_stream()
+                elif self._config_idle_suspend and not self._stream_suspended and self._suspend_task is None:
+                    self._suspend_task = self._bot.loop.create_task(self._delayed_suspend_task())
             # if we are playing in the dj mode, we should update the song context
             if self.playing:
                 self._song_context.update_listeners(listeners)
+                # DJ queue might have changed, the prediction of the next song must be redone, failed one is retried
+                if self._prefetch_task is not None and self._prefetch_task.done() and (
+                        self._prefetched is None or self._prefetched.dj_id != self._bot.users.peek_next_dj()):
+                    log.debug('DJ queue changed or the prediction failed, next song prediction invalidated')
+                    self._restart_prefetch()
             # we also want to update the status message
             await self._update_status()
 
+    #
+    # Playlist interface
+    #
+    async def playlist_changed(self, user_id):
+        # prediction must not be touched while the FSM is switching the songs
+        async with self._transition_lock:
+            if self.playing and self._bot.users.peek_next_dj() == user_id:
+                log.debug('Playlist of the user {} changed, next song prediction invalidated'.format(user_id))
+                self._restart_prefetch()
+
+    async def song_changed(self, song_id):
+        # song blacklisted or merged into another one must not be played because it was predicted before
+        async with self._transition_lock:
+            if self._prefetched is not None and self._prefetched.song_id == song_id:
+                log.debug('Song [{}] changed, next song prediction invalidated'.format(song_id))
+                self._restart_prefetch()
+
     #
     # Internally used methods and callbacks
     #
@@ -422,8 +1063,8 @@ class Player:
             await self._bot.client.change_presence()
 
         elif self.streaming:
-            new_status_message = '**Playing stream:** {}\n**Direct listeners** ({}/{})**:** {}' \
-                .format(self._stream_title, len(direct_listeners), listener_count, dls_str)
+            new_status_message = '**Playing stream:** {}\n**Direct listeners** ({}/{})**:** {}{}' \
+                .format(self._stream_title, len(direct_listeners), listener_count, dls_str, self._latency_info())
             new_stream_title = self._stream_title
             await self._bot.client.change_presence(game=discord.Game(
                 name="a stream for {} listener(s)".format(listener_count)))
@@ -447,10 +1088,10 @@ class Player:
             skip_threshold = ceil(self._config_skip_ratio * listener_count)
 
             new_status_message = '**Playing:** [{0.song_id}] {0.song_title}, **length** {1}:{2:02d}{3}\n' \
-                                 '**Skip votes:** {4}/{5} **Direct listeners** ({6}/{7})**:** {8}\n**Queue:** {9}' \
+                                 '**Skip votes:** {4}/{5} **Direct listeners** ({6}/{7})**:** {8}\n**Queue:** {9}{10}' \
                 .format(self._song_context, self._song_context.song_duration // 60,
                         self._song_context.song_duration % 60, queued_by, skip_voters, skip_threshold,
-                        len(direct_listeners), listener_count, dls_str, djs_str)
+                        len(direct_listeners), listener_count, dls_str, djs_str, self._latency_info())
 
             queued_by = '' if self._song_context.dj_id is None else ', queued by {}'.format(
                 names[self._song_context.dj_id])
@@ -468,10 +1109,18 @@ class Player:
             self._status_protection_count = 0
             log.debug("New status message created")
 
-    async def _get_song(self, dj, retries=3):
+    def _latency_info(self):
+        # latency is worth showing only if both of the audiences are present
+        direct_latency = self._bot.stream.latency
+        if direct_latency is None or not self._bot.voice.is_connected():
+            return ''
+        return '\n**Latency:** voice {:.0f} ms, direct stream {:.0f} ms'.format(self._pcm_thread.voice_latency * 1000,
+                                                                                 direct_latency * 1000)
+
+    async def _get_song(self, dj, prefetched=None, retries=3):
         for _ in range(retries):
             try:
-                song = await self._database.get_next_song(dj)
+                song = await self._database.get_next_song(dj, prefetched)
             except LookupError:  # no more songs in DJ's playlist
                 await self._bot.users.leave_queue(dj)
                 await self._bot.whisper_id(dj, 'Your playlist is empty. Please add more songs and rejoin the DJ queue.')
@@ -492,7 +1141,7 @@ class Player:
     async def _get_stream_info(self):
         func = functools.partial(self._ytdl.extract_info, self._stream_url, download=False)
         try:
-            info = await self._bot.loop.run_in_executor(None, func)
+            info = await self._bot.loop.run_in_executor(self._bot.scheduling.extraction_executor, func)
         except youtube_dl.DownloadError as e:
             await self._bot.message('Failed to obtain stream information: {}'.format(str(e)))
             return False
@@ -506,24 +1155,182 @@ class Player:
         if 'url' not in info:
             await self._bot.message('Failed to extract stream URL, is the link valid?')
             return False
-        self._stream_url = info['url']
+        self._stream_media_url = info['url']
+        self._stream_codec = info.get('acodec')
+        self._stream_live = bool(info.get('is_live'))
         return True
 
-    def _spawn_ffmpeg(self):
-        if self.streaming:
-            url = self._stream_url
-        elif self.playing:
-            url = self._song_context.song_url
+    def _start_decoder(self):
+        # the predicted song might be decoding already, it is used only if the prediction was right
+        preloaded, self._preloaded = self._preloaded, None
+        # decoder might have been released already, if the song ended before the transition was done
+        if preloaded is not None and self.playing and preloaded[0] is self._song_context and \
+                preloaded[1] in self._decoders:
+            log.debug('Using preloaded decoder for the song [{}]'.format(self._song_context.song_id))
+            self._decoder = preloaded[1]
         else:
-            raise RuntimeError('Player is in an invalid state')
-
-        args = shlex.split(self._ffmpeg_command.format(shlex.quote(url)))
+            if preloaded is not None:
+                self._pcm_thread.unqueue(preloaded[1])
+            self._decoder = self._create_decoder(self._song_context if self.playing else None)
+        self._pcm_thread.attach(self._decoder)
+        if self.playing:
+            self._request_loudness_analysis(self._song_context, self._decoder)
+
+    async def _refresh_source(self, song_context):
+        # song resolved to a cached file which is not there anymore must be played from its remote source
+        if self._is_remote(song_context.song_url) or self._cache.get(song_context.song_uuri) is not None:
+            return
+        log.debug('Cached file of the song [{}] was evicted, looking up its source again'
+                  .format(song_context.song_id))
         try:
-            self._ffmpeg = subprocess.Popen(args)
-        except FileNotFoundError as e:
-            raise RuntimeError('ffmpeg executable was not found') from e
-        except subprocess.SubprocessError as e:
-            raise RuntimeError('Popen failed: {0.__name__} {1}'.format(type(e), str(e))) from e
+            await self._database.refresh_source(song_context)
+        except UnavailableSongError as e:
+            # decoder fails to open the file and the failure is reported then
+            await self._bot.log('Song [{}] *{}* was flagged due to a download error'.format(e.song_id, e.song_title))
+
+    @staticmethod
+    def _is_remote(url):
+        return url.startswith(('http://', 'https://'))
+
+    def _create_decoder(self, song_context=None):
+        filters = ''
+        cache_output = ''
+        cache_uuri = None
+        if song_context is None:
+            if not self.streaming:
+                raise RuntimeError('Player is in an invalid state')
+            url = self._stream_media_url
+            codec = self._stream_codec
+        else:
+            url = song_context.song_url
+            codec = song_context.song_codec
+            uuri = song_context.song_uuri
+            cached_file = self._cache.get(uuri)
+            if cached_file is not None:
+                log.debug('Playing song {} from the cache'.format(uuri))
+                url = cached_file
+            elif self._cache.enabled:
+                # store the song in the cache while playing, unless another decoder is storing it already
+                temporary_path = self._cache.temporary_path(uuri, codec)
+                if temporary_path is not None:
+                    cache_uuri = uuri
+                    cache_output = self._ffmpeg_cache_output.format(shlex.quote(temporary_path))
+
+            # apply the loudness normalization, songs not analyzed yet are analyzed once they are played
+            loudness = song_context.song_loudness
+            if self._config_loudness_target is not None and loudness is not None:
+                integrated, peak = loudness
+                gain = min(self._config_loudness_target - integrated, self._loudness_max_peak - peak)
+                if abs(gain) >= self._loudness_min_gain:
+                    filters = self._ffmpeg_volume_filter.format(gain)
+
+        # reconnection options are accepted for the http inputs only
+        input_options = self._ffmpeg_remote_options if self._is_remote(url) else ''
+        # opus packets can be sent to discord directly, unless they are altered by the filters
+        passthrough = self._config_passthrough and codec == 'opus' and not filters
+
+        if song_context is None:
+            name = 'Decoder (stream)'
+            # live stream is reconnected if it fails, restarting anything else would start it over
+            restart_policy = supervisor.RestartPolicy.ON_FAILURE if self._stream_live else \
+                supervisor.RestartPolicy.NEVER
+        else:
+            name = 'Decoder [{}]'.format(song_context.song_id)
+            restart_policy = supervisor.RestartPolicy.NEVER
+
+        args = shlex.split(self._ffmpeg_command.format(input_options, shlex.quote(url), filters) + cache_output)
+        decoder = Decoder(self._bot.loop, name, args, self._config_pipe_size, self._bot.voice.encoder.frame_size,
+                          song_context=song_context, cache_uuri=cache_uuri, passthrough=passthrough,
+                          restart_policy=restart_policy, stall_timeout=self._config_stall_timeout,
+                          spawn_callback=self._bot.scheduling.setup_ffmpeg_process)
+        self._decoders.add(decoder)
+        return decoder
+
+    def _release_decoder(self, decoder):
+        if decoder not in self._decoders:
+            return
+        self._decoders.remove(decoder)
+        self._bot.loop.create_task(self._stop_decoder(decoder))
+
+    async def _stop_decoder(self, decoder):
+        returncode = await decoder.stop()
+
+        # song is cached only if it was downloaded completely
+        if decoder.cache_uuri is not None:
+            song_id = self._loudness_pending.pop(decoder.cache_uuri, None)
+            if returncode == 0:
+                self._cache.commit(decoder.cache_uuri)
+                if song_id is not None:
+                    self._analyze_loudness(song_id, self._cache.get(decoder.cache_uuri))
+            else:
+                self._cache.discard(decoder.cache_uuri)
+
+        # decoder which was not stopped by us should always exit successfully
+        if decoder.eof and returncode:
+            await self._decoding_failed(decoder.song_context, returncode)
+
+    async def _decoding_failed(self, song_context, returncode):
+        if song_context is None:
+            log.warning('Stream decoder exited with status {}, input ended prematurely'.format(returncode))
+            await self._bot.message('Stream ended prematurely because of a decoding error')
+            return
+        log.warning('Decoder of the song [{}] exited with status {}, input ended prematurely'
+                    .format(song_context.song_id, returncode))
+        # handled the same way as the download errors, the flag is cleared after the next successful download
+        await self._database.flag_failed(song_context.song_id)
+        await self._bot.log('Song [{}] *{}* was flagged due to a decoding error'
+                            .format(song_context.song_id, song_context.song_title))
+        await self._bot.message('Song [{}] *{}* ended prematurely because of a decoding error'
+                                .format(song_context.song_id, song_context.song_title))
+
+    def _request_loudness_analysis(self, song_context, decoder):
+        # only the songs actually played are analyzed, the predicted ones might never be
+        if self._config_loudness_target is None or song_context.song_loudness is not None:
+            return
+        if decoder.cache_uuri is not None:
+            # cached file will be analyzed, there is no need to download the song twice
+            self._loudness_pending[decoder.cache_uuri] = song_context.song_id
+            return
+        cached = self._cache.lookup(song_context.song_uuri)
+        if cached is not None:
+            self._analyze_loudness(song_context.song_id, cached[0])
+        else:
+            url = song_context.song_url
+            input_options = self._ffmpeg_remote_options if self._is_remote(url) else ''
+            self._analyze_loudness(song_context.song_id, url, input_options)
+
+    def _analyze_loudness(self, song_id, source, input_options=''):
+        if song_id in self._loudness_queued:
+            return
+        self._loudness_queued.add(song_id)
+        self._loudness_queue.put_nowait((song_id, source, input_options))
+
+    async def task_loudness_analysis(self):
+        while True:
+            song_id, source, input_options = await self._loudness_queue.get()
+            log.debug('Analyzing loudness of the song [{}]'.format(song_id))
+
+            args = shlex.split(self._loudness_command.format(input_options, shlex.quote(source)))
+            func = functools.partial(subprocess.run, args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.PIPE, universal_newlines=True)
+            try:
+                result = await self._bot.loop.run_in_executor(self._bot.scheduling.extraction_executor, func)
+            except (OSError, subprocess.SubprocessError):
+                log.warning('Loudness analysis of the song [{}] failed'.format(song_id), exc_info=True)
+                continue
+            finally:
+                self._loudness_queued.discard(song_id)
+
+            # the summary is printed at the end, so the last values are the ones we are looking for
+            integrated = self._loudness_regex.findall(result.stderr)
+            peak = self._peak_regex.findall(result.stderr)
+            if result.returncode != 0 or not integrated or not peak:
+                log.warning('Loudness analysis of the song [{}] failed, ffmpeg returned {}'
+                            .format(song_id, result.returncode))
+                continue
+
+            log.debug('Song [{}] loudness: {} LUFS, true peak: {} dBFS'.format(song_id, integrated[-1], peak[-1]))
+            await self._database.set_loudness(song_id, float(integrated[-1]), float(peak[-1]))
 
     #
     # Player FSM
@@ -549,6 +1356,7 @@ class Player:
                 # clear the queue and dj_cooldown to behave as intended next time
                 await self._bot.users.clear_queue()
                 self._apply_cooldown = True
+                self._cancel_prefetch()
             #
             # STREAM_MODE
             #
@@ -556,23 +1364,30 @@ class Player:
                 # clear the queue and dj_cooldown to behave as intended next time
                 await self._bot.users.clear_queue()
                 self._apply_cooldown = True
+                self._cancel_prefetch()
                 # when the stream ends or is interrupted, next state should be 'stopped'
                 self._next_state = PlayerState.STOPPED
                 # get stream info
                 if not await self._get_stream_info():
                     continue
-                # let's play!
-                self._spawn_ffmpeg()
+                # let's play! unless there is nobody to play for
+                if self._config_idle_suspend and not self._bot.users.get_current_listeners():
+                    log.info('Nobody is listening, stream is suspended')
+                    self._stream_suspended = True
+                else:
+                    self._start_decoder()
             #
             # DJ_* MODES
             #
             elif self.waiting:
                 self._apply_cooldown = True
                 self._next_state = PlayerState.DJ_PLAYING
+                self._cancel_prefetch()
                 # there is not much to do except wait
 
             elif self.cooldown:
                 self._next_state = PlayerState.DJ_PLAYING
+                self._cancel_prefetch()
                 # clear the flag indicating cooldown should be applied so next time it is skipped
                 self._apply_cooldown = False
                 # we will create a task that will trigger the transition
@@ -585,13 +1400,17 @@ class Player:
                     self._next_state = PlayerState.DJ_WAITING
                     continue
 
+                # prediction made during the previous song is used only if it turns out to be right
+                prefetched = self._prefetched
+                self._prefetched = None
+
                 # try to get a next dj and a song
                 dj = await self._bot.users.get_next_dj()
 
                 while dj is not None:
                     # we have a potential candidate for a dj, but nothing is certain at this point
                     # we will try to get a playable song, 3 times, then moving on to the next dj
-                    self._song_context = await self._get_song(dj)
+                    self._song_context = await self._get_song(dj, prefetched)
                     if self._song_context is not None:
                         break
                     dj = await self._bot.users.get_next_dj()
@@ -604,7 +1423,7 @@ class Player:
 
                     # ok, now we should just pick a song and play it
                     try:
-                        self._song_context = await self._database.get_autoplaylist_song()
+                        self._song_context = await self._database.get_autoplaylist_song(prefetched=prefetched)
                     except UnavailableSongError as e:
                         # we need to log this to the logging channel
                         await self._bot.log('Song [{}] *{}* was flagged due to a download error'
@@ -627,7 +1446,16 @@ class Player:
                 # so let's clear a flag and play it!
                 nothing_to_play = False
                 self._song_context.update_listeners(listeners)
-                self._spawn_ffmpeg()
+                await self._refresh_source(self._song_context)
+                self._start_decoder()
+                # start preparing the next song
+                self._song_start = self._bot.loop.time()
+                self._start_prefetch()
+                # the next song will be started before this one ends
+                if self._config_crossfade and \
+                        self._song_context.song_duration > self._config_crossfade * self._crossfade_min_ratio:
+                    self._crossfade_task = self._bot.loop.create_task(
+                        self._delayed_crossfade_task(self._song_context.song_duration))
 
             # update status message and ICY meta information
             if not (self.cooldown and nothing_to_play):
@@ -652,8 +1480,20 @@ class Player:
 
             # update song stats
             if self.playing:
+                # result of the finished prediction is kept, unfinished one is abandoned
+                if self._prefetch_task is not None and not self._prefetch_task.done():
+                    self._cancel_prefetch()
+                self._prefetch_task = None
+                # if the transition was triggered otherwise, crossfade task is not needed anymore
+                if self._crossfade_task is not None:
+                    self._crossfade_task.cancel()
+                    with suppress(asyncio.CancelledError):
+                        await self._crossfade_task
+                    self._crossfade_task = None
                 # we need to actually wait for this to ensure proper functionality of overplaying protection
-                await self._database.update_stats(self._song_context)
+                # song which could not be started at all was not played, it is not counted
+                if not self._decoder_failed:
+                    await self._database.update_stats(self._song_context)
                 self._song_context = None
 
             # if we were in cooldown, cancel cooldown task if not finished
@@ -662,6 +1502,14 @@ class Player:
                 with suppress(asyncio.CancelledError):
                     await cooldown_task
 
+            # if we were streaming, the suspended decoder is not known to the PCM thread and must be released here
+            elif self.streaming:
+                await self._cancel_suspend()
+                if self._stream_suspended and self._decoder is not None:
+                    self._release_decoder(self._decoder)
+                    self._decoder = None
+                self._stream_suspended = False
+
             # if we were in stopped state, cancel auto transition task if not finished
             elif self.stopped and self._auto_transition_task is not None:
                 self._auto_transition_task.cancel()
@@ -669,28 +1517,140 @@ class Player:
                     await self._auto_transition_task
                 self._auto_transition_task = None
 
-            # kill ffmpeg if still running
-            if self._ffmpeg is not None and self._ffmpeg.poll() is None:
-                self._ffmpeg.kill()
-                self._ffmpeg.communicate()
+            self._decoder_failed = False
 
-            # clean the IPC pipes used
-            self._pcm_thread.flush()
+            # let the previous input fade out while the next one is being started, or stop it right away
+            if self._decoder is not None:
+                if self._config_crossfade:
+                    self._pcm_thread.fade_out(self._decoder)
+                else:
+                    self._pcm_thread.detach(self._decoder)
+                self._decoder = None
 
     #
     # Other helper methods
     #
-    def _playback_ended_callback(self):
-        self._bot.loop.call_soon_threadsafe(self._playback_ended)
+    def _input_ended_callback(self, decoder):
+        self._bot.loop.call_soon_threadsafe(self._input_ended, decoder)
 
-    def _playback_ended(self):  # TODO: atomicity provided by GIL
-        if self._transition_lock.locked():
-            # assuming the FSM is doing a transition already
+    def _release_decoder_callback(self, decoder):
+        self._bot.loop.call_soon_threadsafe(self._release_decoder, decoder)
+
+    def _input_ended(self, decoder):
+        self._bot.loop.create_task(self._input_ended_task(decoder))
+
+    async def _input_ended_task(self, decoder):
+        # the end is handled once the lock is released, it is not lost if the lock is held by something else
+        async with self._transition_lock:
+            # end of the input replaced by the player in the meantime is not a reason for a transition
+            if decoder is not self._decoder:
+                return
+            if decoder.start_failed and (self.playing or self.streaming):
+                # all the other songs would fail the same way, skipping through them would only use up the playlists
+                self._decoder_failed = True
+                self._next_state = PlayerState.STOPPED
+                self._switch_state.set()
+                await self._bot.message('Player was stopped, decoder could not be started')
+                return
+            if self.playing or self.streaming:
+                self._switch_state.set()
+            if self.streaming and self._config_stream_end_transition:
+                self._auto_transition_task = self._bot.loop.create_task(self._delayed_stream_end_transition_task())
+
+    def _start_prefetch(self):
+        if not self._config_prefetch_time or not self.playing:
+            return
+        if self._prefetch_task is not None:
+            self._prefetch_task.cancel()
+        delay = self._song_start + self._song_context.song_duration - self._config_prefetch_time - \
+            self._bot.loop.time()
+        self._prefetch_task = self._bot.loop.create_task(self._prefetch_next_song(self._song_context.song_id,
+                                                                                  max(0, delay)))
+
+    def _cancel_prefetch(self):
+        if self._prefetch_task is not None:
+            self._prefetch_task.cancel()
+            self._prefetch_task = None
+        self._prefetched = None
+        if self._preloaded is not None:
+            self._pcm_thread.unqueue(self._preloaded[1])
+            self._preloaded = None
+
+    def _restart_prefetch(self):
+        self._cancel_prefetch()
+        self._start_prefetch()
+
+    async def _prefetch_next_song(self, current_song_id, delay):
+        await asyncio.sleep(delay, loop=self._bot.loop)
+
+        song = None
+        dj = self._bot.users.peek_next_dj()
+        while True:
+            if dj is not None:
+                song = await self._database.peek_next_song(dj)
+            else:
+                try:
+                    song = await self._database.get_autoplaylist_song(exclude=current_song_id)
+                except UnavailableSongError:
+                    song = None
+            # DJ queue could have changed while the song was being resolved, try again in such case
+            if dj == self._bot.users.peek_next_dj():
+                break
+            dj = self._bot.users.peek_next_dj()
+
+        if song is not None:
+            log.debug('Next song prefetched: [{0.song_id}] {0.song_title}'.format(song))
+        self._prefetched = song
+
+        # decoder of the next song is started in advance, automatic playlist song must wait for the cooldown though
+        if song is None or not self._config_preload or (song.dj_id is None and self._apply_cooldown):
             return
-        if self.playing or self.streaming:
+        await self._refresh_source(song)
+        self._preloaded = (song, self._create_decoder(song))
+        self._pcm_thread.queue(self._preloaded[1])
+
+    async def _cancel_suspend(self):
+        if self._suspend_task is not None:
+            self._suspend_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._suspend_task
+            self._suspend_task = None
+
+    def _suspend_stream(self):
+        self._stream_suspended = True
+        if self._decoder is None:
+            return
+        if self._stream_live:
+            # there is no point in keeping a live source, it will be reconnected on resume
+            log.info('Nobody is listening, live stream is disconnected')
+            self._pcm_thread.detach(self._decoder)
+            self._decoder = None
+        else:
+            log.info('Nobody is listening, stream is suspended')
+            self._pcm_thread.park(self._decoder)
+            self._decoder.suspend()
+
+    async def _resume_stream(self):
+        self._stream_suspended = False
+        if self._decoder is not None:
+            log.info('Resuming the suspended stream')
+            self._decoder.resume()
+            self._pcm_thread.attach(self._decoder)
+            return
+
+        # media URL might have expired in the meantime, it must be extracted again
+        log.info('Reconnecting the stream')
+        if await self._get_stream_info():
+            self._start_decoder()
+        else:
             self._switch_state.set()
-        if self.streaming and self._config_stream_end_transition:
-            self._auto_transition_task = self._bot.loop.create_task(self._delayed_stream_end_transition_task())
+
+    async def _delayed_suspend_task(self):
+        await asyncio.sleep(self._config_idle_suspend, loop=self._bot.loop)
+        async with self._transition_lock:
+            self._suspend_task = None
+            if self.streaming and not self._bot.users.get_current_listeners():
+                self._suspend_stream()
 
     async def _delayed_dj_task(self):
         await asyncio.sleep(15, loop=self._bot.loop)
@@ -698,6 +1658,16 @@ class Player:
             if self.cooldown:
                 self._switch_state.set()
 
+    async def _delayed_crossfade_task(self, duration):
+        # playback position is used to account for the decoder start-up and buffering
+        remaining = duration - self._config_crossfade - self._pcm_thread.position
+        while remaining > 0:
+            await asyncio.sleep(remaining, loop=self._bot.loop)
+            remaining = duration - self._config_crossfade - self._pcm_thread.position
+        async with self._transition_lock:
+            if self.playing:
+                self._switch_state.set()
+
     async def _delayed_stream_end_transition_task(self):
         await asyncio.sleep(self._config_stream_end_transition, loop=self._bot.loop)
         async with self._transition_lock:
@@ -0,0 +1,90 @@
+import concurrent.futures
+import functools
+import logging
+import os
+import threading
+
+# set up the logger
+log = logging.getLogger('ddmbot.scheduling')
+
+
+def _parse_cpus(value):
+    # list of CPUs and CPU ranges, e.g. '0,2-3', empty value means no restriction
+    cpus = set()
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _try_apply(name, description, func, *args):
+    try:
+        func(*args)
+    except OSError as e:
+        log.warning('{}: Cannot set the {}: {}'.format(name, description, str(e)))
+        return False
+    return True
+
+
+class _LowPriorityExecutor(concurrent.futures.ThreadPoolExecutor):
+    def __init__(self, max_workers, nice):
+        super().__init__(max_workers, thread_name_prefix='LowPriority')
+        self._nice = nice
+        self._local = threading.local()
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(functools.partial(self._run, fn), *args, **kwargs)
+
+    def _run(self, fn, *args, **kwargs):
+        # niceness applies to the worker thread only, it is set once as it cannot be lowered back without privileges
+        if self._nice and not getattr(self._local, 'applied', False):
+            self._local.applied = True
+            _try_apply('LowPriorityExecutor', 'niceness', os.setpriority, os.PRIO_PROCESS, 0, self._nice)
+        return fn(*args, **kwargs)
+
+
+class Scheduling:
+    # number of threads available for the metadata extraction and analysis
+    _extraction_workers = 4
+
+    def __init__(self, config):
+        try:
+            self._audio_cpus = _parse_cpus(config['audio_cpus'])
+            self._ffmpeg_cpus = _parse_cpus(config['ffmpeg_cpus'])
+        except ValueError as e:
+            raise ValueError('Provided \'audio_cpus\' or \'ffmpeg_cpus\' is invalid') from e
+        self._audio_priority = int(config['audio_priority'])
+        if self._audio_priority < 0 or self._audio_priority > 99:
+            raise ValueError('Provided \'audio_priority\' is invalid')
+        self._audio_nice = int(config['audio_nice'])
+        self._ffmpeg_nice = int(config['ffmpeg_nice'])
+
+        self._extraction_executor = _LowPriorityExecutor(self._extraction_workers, int(config['extraction_nice']))
+
+    @property
+    def extraction_executor(self):
+        return self._extraction_executor
+
+    def setup_ffmpeg_process(self, name, pid):
+        # applied by the parent right after the spawn, preexec functions are not safe in a multithreaded process
+        if self._ffmpeg_cpus:
+            _try_apply(name, 'CPU affinity', os.sched_setaffinity, pid, self._ffmpeg_cpus)
+        if self._ffmpeg_nice:
+            _try_apply(name, 'niceness', os.setpriority, os.PRIO_PROCESS, pid, self._ffmpeg_nice)
+
+    def setup_audio_thread(self, name):
+        # must be called by the audio thread itself, all the settings apply to the calling thread only
+        if self._audio_cpus:
+            _try_apply(name, 'CPU affinity', os.sched_setaffinity, 0, self._audio_cpus)
+        # realtime scheduling takes precedence, niceness is used if it is not configured or permitted
+        if self._audio_priority and _try_apply(name, 'realtime priority', os.sched_setscheduler, 0, os.SCHED_FIFO,
+                                               os.sched_param(self._audio_priority)):
+            return
+        if self._audio_nice:
+            _try_apply(name, 'niceness', os.setpriority, os.PRIO_PROCESS, 0, self._audio_nice)
+
+    def shutdown(self):
+        self._extraction_executor.shutdown(wait=False)
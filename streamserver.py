@@ -1,99 +1,344 @@
+import array
 import asyncio
-import errno
+import collections
+import fcntl
+import functools
 import logging
 import os
 import shlex
+import socket
 import subprocess
+import termios
 import threading
-import time
 from aiohttp import web, errors
 from contextlib import suppress
+from math import ceil
 
-import awaitablelock
+import pcmring
+import supervisor
 
 # set up the logger
 log = logging.getLogger('ddmbot.streamserver')
 
+# socket option not exposed by older python versions, extracted from linux API headers
+_TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT', 25)
+
+# sampling frequencies indexed by the ADTS header field, see ISO/IEC 14496-3 section 1.6.3.4
+_ADTS_SAMPLING_RATES = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350)
+# MPEG audio layer III bitrates [kbps] and sampling frequencies indexed by the header fields, see ISO/IEC 11172-3 and
+# ISO/IEC 13818-3, MPEG-1 is version 3, MPEG-2 is version 2 and the unofficial MPEG-2.5 is version 0
+_MP3_BITRATES = ((0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+                 (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320))
+_MP3_SAMPLING_RATES = ((11025, 12000, 8000), None, (22050, 24000, 16000), (44100, 48000, 32000))
+# length of the headers, the frame length can be determined once this many bytes are available
+_ADTS_HEADER_LEN = 7
+_MP3_HEADER_LEN = 4
+
+
+def _adts_frame_length(buffer, offset):
+    # length of the frame starting at the offset, 0 if there is no valid header
+    if buffer[offset] != 0xff or buffer[offset + 1] & 0xf6 != 0xf0 or (buffer[offset + 2] >> 2) & 0x0f >= \
+            len(_ADTS_SAMPLING_RATES):
+        return 0
+    length = (buffer[offset + 3] & 0x03) << 11 | buffer[offset + 4] << 3 | buffer[offset + 5] >> 5
+    return length if length >= _ADTS_HEADER_LEN else 0
+
+
+def _adts_duration(frame):
+    # each raw data block holds 1024 samples at the core sampling rate, SBR does not change the duration
+    sampling_rate = _ADTS_SAMPLING_RATES[(frame[2] >> 2) & 0x0f]
+    blocks = (frame[6] & 0x03) + 1
+    return 1024 * blocks / sampling_rate
+
+
+def _mp3_frame_length(buffer, offset):
+    version = (buffer[offset + 1] >> 3) & 0x03
+    layer = (buffer[offset + 1] >> 1) & 0x03
+    bitrate_index = buffer[offset + 2] >> 4
+    sampling_rate_index = (buffer[offset + 2] >> 2) & 0x03
+    # free format bitrate is not supported, the frame length could not be determined from the header
+    if buffer[offset] != 0xff or buffer[offset + 1] & 0xe0 != 0xe0 or version == 1 or layer != 1 or \
+            bitrate_index in (0, 15) or sampling_rate_index == 3:
+        return 0
+    bitrate = _MP3_BITRATES[version == 3][bitrate_index] * 1000
+    sampling_rate = _MP3_SAMPLING_RATES[version][sampling_rate_index]
+    padding = (buffer[offset + 2] >> 1) & 0x01
+    return (144 if version == 3 else 72) * bitrate // sampling_rate + padding
+
+
+def _mp3_duration(frame):
+    # layer III frame holds 1152 samples in MPEG-1, half of that in the lower sampling rate extensions
+    version = (frame[1] >> 3) & 0x03
+    sampling_rate = _MP3_SAMPLING_RATES[version][(frame[2] >> 2) & 0x03]
+    return (1152 if version == 3 else 576) / sampling_rate
+
+
+class Framer:
+    __slots__ = ['_name', '_header_len', '_frame_length', '_duration', '_buffer', '_synchronized']
+
+    def __init__(self, name, header_len, frame_length, duration):
+        # frame_length returns the length of the frame starting at the offset, 0 if there is no valid header
+        self._name = name
+        self._header_len = header_len
+        self._frame_length = frame_length
+        self._duration = duration
+        self._buffer = bytearray()
+        self._synchronized = True  # to control log spam
 
-class AacProcessor(threading.Thread):
-    def __init__(self, pipe_path, frame_len, bitrate, output_callback):
-        if not callable(output_callback):
-            raise TypeError('Output callback must be a callable object')
+    @property
+    def buffered(self):
+        # number of bytes of the incomplete frame
+        return len(self._buffer)
+
+    def duration(self, frame):
+        return self._duration(frame)
+
+    def feed(self, data):
+        # returns the list of the frames completed by the data
+        buffer = self._buffer
+        buffer += data
+        frames = list()
+        offset = 0
+        while len(buffer) - offset >= self._header_len:
+            length = self._frame_length(buffer, offset)
+            if not length:
+                # garbage is skipped up to the next syncword, both of the formats start it with a whole byte
+                if self._synchronized:
+                    log.warning('{}: Lost synchronization'.format(self._name))
+                    self._synchronized = False
+                offset = buffer.find(b'\xff', offset + 1)
+                if offset < 0:
+                    offset = len(buffer)
+                continue
+            if len(buffer) - offset < length:
+                break
+            self._synchronized = True
+            frames.append(bytes(buffer[offset:offset + length]))
+            offset += length
+        del buffer[:offset]
+        return frames
+
+
+# ffmpeg output options, framer factory and content type of the supported stream formats
+# no tags or info frames are written to the mp3 stream, so it consists of the audio frames only
+_STREAM_FORMATS = {
+    'adts': ('-f adts', functools.partial(Framer, 'AdtsFramer', _ADTS_HEADER_LEN, _adts_frame_length, _adts_duration),
+             'audio/aac'),
+    'mp3': ('-f mp3 -id3v2_version 0 -write_xing 0',
+            functools.partial(Framer, 'Mp3Framer', _MP3_HEADER_LEN, _mp3_frame_length, _mp3_duration), 'audio/mpeg')
+}
+
+
+def _split_frames(data, framer):
+    # splits the stream into frames, returns them together with the duration of a single frame in seconds
+    frames = framer.feed(data)
+    if not frames or framer.buffered:
+        raise RuntimeError('Invalid encoder output')
+    return frames, framer.duration(frames[0])
+
+
+class StreamProcessor(threading.Thread):
+    # maximum amount of the encoder output read in advance, the encoder is blocked by the pipe afterwards [seconds]
+    _max_buffered_time = 1
+    # amount of the encoder output needed to switch from the silence back to the program [seconds]
+    _resume_time = 0.2
+
+    def __init__(self, name, pipe_fd, framer, bitrate, clock, scheduling, silence, program, input_latency,
+                 output_callback):
+        if not callable(output_callback) or not callable(input_latency):
+            raise TypeError('Output callback and input latency must be callable objects')
 
         super().__init__()
 
-        self._pipe_fd = os.open(pipe_path, os.O_RDONLY | os.O_NONBLOCK)
+        self._name = name
+        self._pipe_fd = pipe_fd  # non-blocking, owned by the processor
+        self._framer = framer
+        self._frames = collections.deque()
+        self._byte_period = 8 / bitrate
+
+        # pre-encoded silent frames are served instead of the encoder output while there is no program
+        # encoder settings are the same, so their duration is used to pace all the frames
+        self._silence_frames, self._frame_period = silence
+        self._silence_index = 0
+        self._program = program
+        self._max_frames = ceil(self._max_buffered_time / self._frame_period)
+        self._resume_frames = ceil(self._resume_time / self._frame_period)
+
+        self._pacer = clock.pacer(name, self._frame_period)
+        self._scheduling = scheduling
 
-        self._frame_len = frame_len
-        self._frame_period = frame_len * 8 / bitrate
+        # time the audio spends in the buffers, exponential moving average, None until the first measurement
+        self._input_latency = input_latency
+        self._latency = None
 
         self._play = output_callback
 
         self._end = threading.Event()
 
+    @property
+    def late_frames(self):
+        return self._pacer.late_frames
+
+    @property
+    def resyncs(self):
+        return self._pacer.resyncs
+
+    @property
+    def latency(self):
+        return self._latency
+
     def stop(self):
         self._end.set()
         self.join()
-        self.flush()
         os.close(self._pipe_fd)
 
-    def flush(self):
+    def _available(self):
+        pending = array.array('i', [0])
+        fcntl.ioctl(self._pipe_fd, termios.FIONREAD, pending)
+        return pending[0]
+
+    def _fill(self):
+        # encoder output is split into whole frames, incomplete frame is kept by the framer
         try:
-            os.read(self._pipe_fd, 1048576)  # TODO: change the magic constant
-        except OSError as e:
-            if e.errno != errno.EAGAIN:
-                raise
+            data = os.read(self._pipe_fd, 65536)
+        except BlockingIOError:
+            return
+        self._frames.extend(self._framer.feed(data))
+
+    def _measure_latency(self):
+        # frames are counted using their duration, the bytes not framed yet using the nominal bitrate
+        latency = self._input_latency() + len(self._frames) * self._frame_period + \
+            (self._available() + self._framer.buffered) * self._byte_period
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += (latency - self._latency) * 0.1
 
     def run(self):
-        loops = 0  # loop counter
         input_not_ready = False  # to control log spam
-        data_requested = self._frame_len  # to keep the alignment intact
+        silence = False
+
+        self._scheduling.setup_audio_thread(self._name)
 
-        # capture the starting time
-        start_time = time.clock_gettime(time.CLOCK_MONOTONIC_RAW)
+        # start the clock, a single frame is sent each period
+        self._pacer.start()
         while not self._end.is_set():
-            # increment loop counter
-            loops += 1
+            if len(self._frames) < self._max_frames:
+                self._fill()
+
+            # encoder output is used again once there is enough of it, frames are whole, so the switch is seamless
+            if silence and len(self._frames) >= self._resume_frames:
+                log.debug('{}: Program resumed'.format(self._name))
+                silence = False
+
+            if not silence:
+                if self._frames:
+                    input_not_ready = False
+                    frame = self._frames.popleft()
+                    self._play(frame, self._framer.duration(frame))
+                    self._measure_latency()
+                elif not self._program.is_set():
+                    log.debug('{}: Program ended, serving silence'.format(self._name))
+                    silence = True
+                    input_not_ready = False
+                # prevent spamming the log with megabytes of text
+                elif not input_not_ready:
+                    log.error('{}: Buffer not ready'.format(self._name))
+                    input_not_ready = True
+
+            if silence:
+                frame = self._silence_frames[self._silence_index]
+                self._silence_index = (self._silence_index + 1) % len(self._silence_frames)
+                self._play(frame, self._frame_period)
+
+            # wait for the next transmission time
+            self._pacer.wait()
+
+
+class PcmFeeder(threading.Thread):
+    def __init__(self, name, reader, output_fd, frame_period, scheduling):
+        super().__init__()
 
-            # try to read a frame from the input -- should be there all the time
+        self._name = name
+        self._reader = reader
+        self._output_fd = output_fd
+        self._frame_period = frame_period
+        self._frame_len = reader.frame_len
+        self._scheduling = scheduling
+        self._end = threading.Event()
+
+    @property
+    def reader(self):
+        return self._reader
+
+    @property
+    def latency(self):
+        # audio waiting in the ring buffer and in the encoder input pipe
+        pending = array.array('i', [0])
+        fcntl.ioctl(self._output_fd, termios.FIONREAD, pending)
+        return (self._reader.occupancy + pending[0] / self._frame_len) * self._frame_period
+
+    def stop(self):
+        # the thread might be blocked writing to the encoder, it ends once the encoder closes its input, then it can
+        # be joined
+        self._end.set()
+        self._reader.close()
+
+    def run(self):
+        dropped_frames = 0  # to control log spam
+
+        self._scheduling.setup_audio_thread(self._name)
+
+        while not self._end.is_set():
+            data = self._reader.read(timeout=0.1)
+            if data is None:
+                continue
+
+            # blocking writes provide the backpressure, the encoder is allowed to take its time
             try:
-                data = os.read(self._pipe_fd, data_requested)
-                # so we apparently got some data, clear the flag and calculate things
-                input_not_ready = False
-                data_len = len(data)
-                if data_len != 0 and data_len != self._frame_len:
-                    log.warning('AacProcessor: Got partial buffer of size {}'.format(data_len))
-
-                # call the callback
-                self._play(data)
-
-                # calculate requested size for the next iteration
-                data_requested -= data_len
-                if data_requested == 0:
-                    data_requested = self._frame_len
-            except OSError as e:
-                if e.errno == errno.EAGAIN:
-                    # prevent spamming the log with megabytes of text
-                    if not input_not_ready:
-                        log.error('AacProcessor: Buffer not ready')
-                        input_not_ready = True
-                else:
-                    raise
+                while data:
+                    data = data[os.write(self._output_fd, data):]
+            except BrokenPipeError:
+                if not self._end.is_set():
+                    log.error('{}: Encoder input was closed unexpectedly'.format(self._name))
+                return
 
-            # calculate next transmission time
-            next_time = start_time + self._frame_period * loops
-            sleep_time = max(0, self._frame_period + (next_time - time.clock_gettime(time.CLOCK_MONOTONIC_RAW)))
-            time.sleep(sleep_time)
+            if self._reader.dropped_frames != dropped_frames:
+                dropped_frames = self._reader.dropped_frames
+                log.warning('{}: Encoder is not keeping up, {} frame(s) dropped so far in {} overrun(s), buffer '
+                            'occupancy {}/{}'.format(self._name, dropped_frames, self._reader.overruns,
+                                                     self._reader.occupancy, self._reader.capacity))
 
 
 class ConnectionInfo:
-    __slots__ = ['_response', '_meta', '_lock', '_init']
+    __slots__ = ['_response', '_transport', '_meta', '_meta_sent', '_queue', '_queued', '_queue_limit', '_wakeup',
+                 '_drain', '_write_limit', '_stall_grace', '_stall_timer', '_stalls', '_terminated', '_reason',
+                 '_closed', '_loop']
 
-    def __init__(self, response: web.StreamResponse, meta: bool, loop: asyncio.AbstractEventLoop):
+    def __init__(self, response: web.StreamResponse, transport: asyncio.Transport, meta: bool, queue_limit: int,
+                 write_limit: int, stall_grace: float, loop: asyncio.AbstractEventLoop):
         self._response = response
+        self._transport = transport
         self._meta = meta
-        self._lock = asyncio.Lock(loop=loop)
-        self._init = True
+        self._meta_sent = False
+
+        # data waiting to be sent, the objects are shared by all the connections and must not be modified
+        self._queue = collections.deque()
+        self._queued = 0  # number of bytes queued
+        self._queue_limit = queue_limit
+        self._wakeup = asyncio.Event(loop=loop)
+        self._drain = None
+
+        # client is stalled while the transport buffer is above the limit, it is kicked if that lasts too long
+        self._write_limit = write_limit
+        self._stall_grace = stall_grace
+        self._stall_timer = None
+        self._stalls = 0
+
+        self._terminated = False
+        self._reason = None
+        self._closed = False
+        self._loop = loop
 
     @property
     def response(self):
@@ -104,77 +349,226 @@ class ConnectionInfo:
         return self._meta
 
     @property
-    def first_send(self):
-        if self._init:
-            self._init = False
+    def first_meta(self):
+        # true if no metadata were sent yet, the current ones must be sent instead of the empty ones
+        if not self._meta_sent:
+            self._meta_sent = True
             return True
         return False
 
-    async def prepare(self):
-        if not self._lock.locked():
-            await self._lock.acquire()
+    @property
+    def closed(self):
+        # true once nothing is being sent anymore, either on request or because the connection broke
+        return self._closed
+
+    @property
+    def reason(self):
+        # reason of the connection being kicked or broken, None if it was terminated on request
+        return self._reason
 
-    async def wait(self):
-        await self._lock.acquire()
+    @property
+    def stalls(self):
+        return self._stalls
+
+    def send(self, data):
+        # false is returned if the queue would overflow, the data are not queued then
+        if self._queued + len(data) > self._queue_limit:
+            return False
+        self._queue.append(data)
+        self._queued += len(data)
+        self._wakeup.set()
+        return True
+
+    async def serve(self):
+        # sends the queued data until terminated or the connection breaks
+        try:
+            while not self._terminated:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._queue and not self._terminated:
+                    # everything queued so far is sent using a single write
+                    data = self._queue.popleft() if len(self._queue) == 1 else b''.join(self._queue)
+                    self._queue.clear()
+                    self._queued = 0
+                    self._response.write(data)
+                    # writing is paused by the transport above the limit, the client gets some time to catch up
+                    if self._transport.get_write_buffer_size() > self._write_limit:
+                        self._stalls += 1
+                        self._stall_timer = self._loop.call_later(self._stall_grace, self.terminate, 'stalled')
+                    self._drain = asyncio.ensure_future(self._response.drain(), loop=self._loop)
+                    try:
+                        await self._drain
+                    finally:
+                        self._drain = None
+                        if self._stall_timer is not None:
+                            self._stall_timer.cancel()
+                            self._stall_timer = None
+        except (errors.DisconnectedError, ConnectionResetError):
+            if not self._terminated:
+                self._reason = 'disconnected'
+        except asyncio.CancelledError:
+            # pending drain is cancelled on termination, the handler itself is cancelled if the client disconnects
+            if not self._terminated:
+                self._reason = 'disconnected'
+                raise
+        finally:
+            self._closed = True
+            self._queue.clear()
+
+    def terminate(self, reason=None):
+        # connection is aborted if the client is kicked for a reason, the data in flight are not waited for
+        if self._terminated:
+            return
+        self._terminated = True
+        self._reason = reason
+        self._wakeup.set()
+        if self._drain is not None:
+            self._drain.cancel()
+        if reason is not None:
+            self._transport.abort()
+
+
+class Rendition:
+    # single format and bitrate of the stream, its encoder runs only while there are any listeners
+    __slots__ = ['path', 'bitrate', 'framer_factory', 'ffmpeg_args', 'queue_limit', 'response_headers', 'silence',
+                 'encoder', 'encoder_input', 'pcm_feeder', 'processor', 'cleanup_task', 'connected', 'connections',
+                 'handoff', 'handoff_scheduled', 'position', 'burst', 'burst_duration', 'meta_changed']
+
+    def __init__(self, path, bitrate, framer_factory, ffmpeg_args, queue_limit, response_headers):
+        self.path = path
+        self.bitrate = bitrate
+        self.framer_factory = framer_factory
+        self.ffmpeg_args = ffmpeg_args
+        self.queue_limit = queue_limit
+        self.response_headers = response_headers
+        self.silence = None
+
+        self.encoder = None
+        self.encoder_input = None
+        self.pcm_feeder = None
+        self.processor = None
+        self.cleanup_task = None
+        self.connected = threading.Event()
 
-    def terminate(self):
-        self._lock.release()
+        # user -> ConnectionInfo
+        self.connections = dict()
+        # data sent by the StreamProcessor thread, passed to the event loop for the distribution
+        self.handoff = collections.deque()
+        self.handoff_scheduled = False
+        self.position = 0  # number of bytes sent since the encoder was started, metadata go at the block boundaries
+        # recently sent frames with their durations and positions
+        self.burst = collections.deque()
+        self.burst_duration = 0.0
+        self.meta_changed = False
 
 
 class StreamServer:
+    # length of the pre-encoded silence, it is served in a loop [seconds]
+    _silence_length = 1
+
     def __init__(self, bot):
         self._bot = bot
         self._config = bot.config['stream_server']
-        self._config_bitrate = int(self._config['bitrate'])
-        self._frame_len = int(self._config['block_size'])
+        self._block_size = int(self._config['block_size'])
 
         self._app = None
         self._server = None
         self._handler = None
 
-        self._lock = awaitablelock.AwaitableLock(loop=bot.loop)
-        # user -> ConnectionInfo
-        self._connections = dict()
-
-        ffmpeg_command = 'ffmpeg -loglevel error -y -f s16le -ar {} -ac {} -i {} -f adts -c:a {} -b:a {}k {}' \
-            .format(bot.voice.encoder.sampling_rate, bot.voice.encoder.channels, shlex.quote(self._config['int_pipe']),
-                    self._config['aac_encoder'], self._config_bitrate, shlex.quote(self._config['aac_pipe']))
+        # connections of all the renditions are manipulated under the same lock, a user can only have one of them
+        self._lock = asyncio.Lock(loop=bot.loop)
+        # client connection tuning and slow client detection
+        self._write_limit = int(self._config['client_write_buffer'])
+        self._stall_grace = float(self._config['client_stall_grace'])
+        self._sndbuf = int(self._config['client_sndbuf'])
+        self._notsent_lowat = int(self._config['client_notsent_lowat'])
+        if self._write_limit <= 0 or self._stall_grace <= 0 or self._sndbuf < 0 or self._notsent_lowat < 0:
+            raise ValueError('Provided client connection settings are invalid')
+        # reason -> number of the connections closed for it, stalls of the closed connections are counted as well
+        self._close_reasons = collections.Counter()
+        self._stalls = 0
+
+        # maximum amount of data queued for a single client
+        self._client_queue_length = float(self._config['client_queue_length'])
+        # recently sent frames are sent to new clients at once to fill their buffers quickly
+        self._burst_length = float(self._config['burst_length'])
+        if self._burst_length < 0 or self._burst_length >= self._client_queue_length:
+            raise ValueError('Provided \'burst_length\' is invalid, it must be shorter than \'client_queue_length\'')
+
+        # PCM frames from the player are passed to the encoders through the ring buffer, each of them has a reader
+        pcm_frame_count = int(float(self._config['pcm_buffer_length']) * 1000 / bot.voice.encoder.frame_length)
+        self._pcm_ring = pcmring.PcmRing(bot.voice.encoder.frame_size, pcm_frame_count)
+
+        # silence is encoded once by the same encoder, so the clients cannot notice the difference
+        self._silence_input = bytes(bot.voice.encoder.frame_size * int(self._silence_length * 1000 /
+                                                                       bot.voice.encoder.frame_length))
+        self._program = threading.Event()
+        self._current_meta = b'\0'
 
-        self._aac_thread = None
-        self._cleanup_task = None
-        self._internal_pipe = os.open(self._config['int_pipe'], os.O_RDONLY | os.O_NONBLOCK)
-        self._ffmpeg = None
-        self._ffmpeg_args = shlex.split(ffmpeg_command)
-        self._connected = threading.Event()
+        # headers shared by all the renditions
+        self._stream_response_headers = {'Cache-Control': 'no-cache', 'Connection': 'close', 'Pragma': 'no-cache',
+                                         'Server': 'DdmBot streaming server', 'Icy-Pub': '0'}
+        for icy_name, config_name in (('Icy-Name', 'name'), ('Icy-Description', 'description'), ('Icy-Genre', 'genre'),
+                                      ('Icy-Url', 'url')):
+            if config_name in self._config and self._config[config_name]:
+                self._stream_response_headers[icy_name] = self._config[config_name]
 
-        self._current_frame = b''
-        self._meta_changed = False
-        self._current_meta = b'\0'
+        # main rendition is the one linked in the playlist, additional ones are configured one per line
+        # path -> Rendition
+        self._renditions = collections.OrderedDict()
+        self._add_rendition(self._config['stream_path'], 'adts', self._config['aac_encoder'], self._config['bitrate'])
+        for line in self._config['renditions'].splitlines():
+            if not line.strip():
+                continue
+            try:
+                self._add_rendition(*line.split())
+            except (TypeError, ValueError) as e:
+                raise ValueError('Provided \'renditions\' is invalid: {}'.format(line.strip())) from e
+        if self._config['playlist_path'] in self._renditions:
+            raise ValueError('Provided \'playlist_path\' is invalid, it is used by a rendition')
 
         # URLs, response headers and payload assembly
         # TODO: handle URL encoding in the future (playlist_path may contain invalid characters)
-        self._playlist_url = 'http://{hostname}:{port}{playlist_path}?token={{}}'.format_map(self._config)
-        self._stream_url = 'http://{hostname}:{port}{stream_path}?token={{}}'.format_map(self._config)
+        url = 'http://{hostname}:{port}{{}}?token={{{{token}}}}'.format_map(self._config)
+        self._playlist_url = url.format(self._config['playlist_path'])
+        self._stream_urls = collections.OrderedDict((path, url.format(path)) for path in self._renditions)
         self._playlist_response_headers = {'Connection': 'close', 'Server': 'DdmBot streaming server', 'Content-type':
                                            'audio/mpegurl'}
         self._playlist_file = '#EXTM3U\r\n#EXTINF:-1,{name}\r\nhttp://{hostname}:{port}{stream_path}?{{}}' \
             .format_map(self._config)
-        self._stream_response_headers = {'Cache-Control': 'no-cache', 'Connection': 'close', 'Pragma': 'no-cache',
-                                         'Server': 'DdmBot streaming server', 'Content-Type': 'audio/aac',
-                                         'Icy-BR': self._config['bitrate'], 'Icy-Pub': '0'}
-
-        for icy_name, config_name in (('Icy-Name', 'name'), ('Icy-Description', 'description'), ('Icy-Genre', 'genre'),
-                                      ('Icy-Url', 'url')):
-            if config_name in self._config and self._config[config_name]:
-                self._stream_response_headers[icy_name] = self._config[config_name]
 
     @property
     def playlist_url(self):
+        # URLs are formatted with the token
         return self._playlist_url
 
     @property
     def stream_url(self):
-        return self._stream_url
+        return self._stream_urls[self._config['stream_path']]
+
+    @property
+    def rendition_urls(self):
+        # path -> URL of the additional renditions
+        return collections.OrderedDict((path, url) for path, url in self._stream_urls.items()
+                                       if path != self._config['stream_path'])
+
+    def _add_rendition(self, path, stream_format, encoder, bitrate):
+        bitrate = int(bitrate)
+        if path in self._renditions or stream_format not in _STREAM_FORMATS or bitrate <= 0:
+            raise ValueError('Provided rendition is invalid')
+        format_args, framer_factory, content_type = _STREAM_FORMATS[stream_format]
+
+        # packets are flushed one by one, so the end of the program is not held back by the output buffering
+        ffmpeg_command = 'ffmpeg -loglevel error -y -f s16le -ar {} -ac {} -i pipe:0 {} -flush_packets 1 -c:a {} ' \
+                         '-b:a {}k pipe:1'.format(self._bot.voice.encoder.sampling_rate,
+                                                  self._bot.voice.encoder.channels, format_args, shlex.quote(encoder),
+                                                  bitrate)
+        response_headers = self._stream_response_headers.copy()
+        response_headers['Content-Type'] = content_type
+        response_headers['Icy-BR'] = str(bitrate)
+
+        self._renditions[path] = Rendition(path, bitrate, framer_factory, shlex.split(ffmpeg_command),
+                                           int(self._client_queue_length * bitrate * 1000 / 8), response_headers)
 
     #
     # Resource management wrappers
@@ -182,7 +576,8 @@ class StreamServer:
     async def init(self):
         # http server initialization
         self._app = web.Application(loop=self._bot.loop)
-        self._app.router.add_route('GET', self._config['stream_path'], self._handle_new_stream)
+        for path in self._renditions:
+            self._app.router.add_route('GET', path, self._handle_new_stream)
         self._app.router.add_route('GET', self._config['playlist_path'], self._handle_new_playlist)
         self._handler = self._app.make_handler()
 
@@ -198,9 +593,17 @@ class StreamServer:
             await self._app.shutdown()
         # close all remaining connections
         async with self._lock:
-            for connection in self._connections.values():
-                connection.terminate()
-            self._connections.clear()
+            for rendition in self._renditions.values():
+                for connection in rendition.connections.values():
+                    connection.terminate()
+                rendition.connections.clear()
+                # encoders and the threads of the running renditions are stopped the same way as after the last
+                # listener, otherwise the threads keep the process alive and the encoders are left behind
+                if rendition.cleanup_task is not None:
+                    rendition.cleanup_task.cancel()
+                    with suppress(asyncio.CancelledError):
+                        await rendition.cleanup_task
+                    await self._last_listener_cleanup(rendition)
         if self._handler is not None:
             await self._handler.finish_connections(10)
         if self._app is not None:
@@ -210,7 +613,49 @@ class StreamServer:
     # Player interface
     #
     def is_connected(self):
-        return self._connected.is_set()
+        return any(rendition.connected.is_set() for rendition in self._renditions.values())
+
+    @property
+    def pcm_ring(self):
+        return self._pcm_ring
+
+    @property
+    def close_reasons(self):
+        return collections.Counter(self._close_reasons)
+
+    @property
+    def stalls(self):
+        return self._stalls
+
+    @property
+    def clock_stats(self):
+        # (path, late frames, resyncs) of the running renditions, counted since their encoders were started
+        return [(rendition.path, rendition.processor.late_frames, rendition.processor.resyncs)
+                for rendition in self._renditions.values() if rendition.processor is not None]
+
+    @property
+    def ring_stats(self):
+        # (path, occupancy, capacity, overruns, dropped frames) of the PCM ring readers of the running renditions
+        return [(rendition.path, rendition.pcm_feeder.reader.occupancy, rendition.pcm_feeder.reader.capacity,
+                 rendition.pcm_feeder.reader.overruns, rendition.pcm_feeder.reader.dropped_frames)
+                for rendition in self._renditions.values() if rendition.pcm_feeder is not None]
+
+    @property
+    def latency(self):
+        # time the audio spends in the bot before it is sent to the direct listeners, the highest one of the running
+        # renditions is reported, None if unknown
+        latencies = [rendition.processor.latency for rendition in self._renditions.values()
+                     if rendition.connected.is_set() and rendition.processor is not None and
+                     rendition.processor.latency is not None]
+        return max(latencies) if latencies else None
+
+    def set_program(self, active):
+        # encoders are not fed while there is no program, the pre-encoded silence is served instead
+        if active != self._program.is_set():
+            if active:
+                self._program.set()
+            else:
+                self._program.clear()
 
     async def set_meta(self, stream_title):
         # assemble metadata
@@ -228,26 +673,27 @@ class StreamServer:
         # prepend the length and pad with zeroes
         metadata = bytes([length]) + metadata.ljust(length * 16, b'\0')
 
-        # atomically update the metadata
-        async with self._lock:
-            log.debug('New metadata set: {}'.format(metadata))
-            self._current_meta = metadata
-            self._meta_changed = True
+        # metadata are only used by the event loop, no locking is needed
+        log.debug('New metadata set: {}'.format(metadata))
+        self._current_meta = metadata
+        for rendition in self._renditions.values():
+            rendition.meta_changed = True
 
     #
     # UserManager interface
     #
     async def disconnect(self, user):
         async with self._lock:
-            if user not in self._connections:
-                return
-            self._connections[user].terminate()
-            self._connections.pop(user)
+            for rendition in self._renditions.values():
+                if user in rendition.connections:
+                    rendition.connections.pop(user).terminate()
 
     #
     # Internal connection handling
     #
     async def _handle_new_stream(self, request):
+        rendition = self._renditions[request.path]
+
         # check for the token validity
         token = request.query_string[6:]
         user = await self._bot.users.get_token_owner(token)
@@ -258,50 +704,41 @@ class StreamServer:
             return response
 
         # assembly the response headers
-        response_headers = self._stream_response_headers.copy()
+        response_headers = rendition.response_headers.copy()
         meta = False
         if 'ICY-METADATA' in request.headers and request.headers['ICY-METADATA'] == '1':
-            response_headers['Icy-MetaInt'] = str(self._frame_len)
+            response_headers['Icy-MetaInt'] = str(self._block_size)
             meta = True
 
-        log.debug('Valid stream request from {}, ICY-METADATA={}'.format(user, meta))
+        log.debug('Valid stream request for {} from {}, ICY-METADATA={}'.format(rendition.path, user, meta))
 
         # create response StreamResponse object
         response = web.StreamResponse(headers=response_headers)
         await response.prepare(request)
         # construct ConnectionInfo object
-        connection = ConnectionInfo(response, meta, self._bot.loop)
-        await connection.prepare()
+        self._tune_transport(request.transport)
+        connection = ConnectionInfo(response, request.transport, meta, rendition.queue_limit, self._write_limit,
+                                    self._stall_grace, self._bot.loop)
 
         # critical section -- we are manipulating the connections
         async with self._lock:
-            if not self._connections:
+            if rendition.encoder is None:
                 # first listener needs to initialize everything
-                log.debug('First listener initialization')
-                # spawn cleanup task
-                self._cleanup_task = self._bot.loop.create_task(self._cleanup_loop())
-                # spawn ffmpeg process
-                try:
-                    self._ffmpeg = subprocess.Popen(self._ffmpeg_args)
-                except FileNotFoundError as e:
-                    raise RuntimeError('ffmpeg executable was not found') from e
-                except subprocess.SubprocessError as e:
-                    raise RuntimeError('Popen failed: {0.__name__} {1}'.format(type(e), str(e))) from e
-                # create processing thread
-                self._aac_thread = AacProcessor(self._config['aac_pipe'], self._frame_len, self._config_bitrate * 1000,
-                                                self._play_audio)
-                # enable input and output
-                self._connected.set()
-                self._aac_thread.start()
-
-            elif user in self._connections and not is_multiuser:
-                # break the existing connection
-                log.debug('Previous connection for user {} found, signalling to terminate'.format(user))
-                self._connections[user].terminate()
-
-            # add the connection object to the _connections dictionary
+                await self._first_listener_init(rendition)
+
             if not is_multiuser:
-                self._connections[user] = connection
+                # break the existing connection, the user might be listening to another rendition
+                for other in self._renditions.values():
+                    if user in other.connections:
+                        log.debug('Previous connection for user {} found, signalling to terminate'.format(user))
+                        other.connections[user].terminate()
+                        if other is not rendition:
+                            # the user is still listening, so the cleanup must not notice this connection
+                            other.connections.pop(user)
+
+                # add the connection object to the connections dictionary
+                rendition.connections[user] = connection
+                self._send_burst(rendition, user, connection)
 
         # notify the UserManager that a new listener was added
         # race condition is possible, but only one of the connections will be served
@@ -310,70 +747,222 @@ class StreamServer:
         else:
             await self._bot.users.add_listener(None, direct=True)
 
-        # wait before terminating
-        log.debug('Waiting for the client termination')
+        # serve the client until terminating
+        log.debug('Serving the client')
         with suppress(asyncio.CancelledError):
-            await connection.wait()
+            await connection.serve()
 
         # now we are supposed to break the connection on request
-        # self._connections.pop(user) left out INTENTIONALLY!
+        # rendition.connections.pop(user) left out INTENTIONALLY!
         # await self._users.remove_listener(user) left out INTENTIONALLY!
-        # cleanup will be done by self._cleanup_task
+        # cleanup will be done by rendition.cleanup_task
 
         log.debug('Stream to {} terminated'.format(user))
         return response
 
+    def _tune_transport(self, transport):
+        # high watermark is the stall threshold, writing is resumed once most of the buffer is sent
+        transport.set_write_buffer_limits(high=self._write_limit)
+        sock = transport.get_extra_info('socket')
+        if sock is None:
+            return
+        try:
+            if self._sndbuf:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._sndbuf)
+            # unsent data are kept in the transport buffer, so the stall can be noticed sooner
+            if self._notsent_lowat:
+                sock.setsockopt(socket.IPPROTO_TCP, _TCP_NOTSENT_LOWAT, self._notsent_lowat)
+        except OSError as e:
+            log.warning('Cannot set the client socket options: {}'.format(str(e)))
+
     async def _handle_new_playlist(self, request):
         # TODO: handle URL encoding
         body = self._playlist_file.format(request.query_string)
         response = web.Response(text=body, headers=self._playlist_response_headers)
         return response
 
-    def _play_audio(self, data):
-        self._current_frame = data if len(self._current_frame) == self._frame_len else self._current_frame + data
-
-        with self._lock:
-            for user, connection in self._connections.items():
-                init = connection.first_send
-                # send data, if the connection is a new one whole frame (part) must be sent
-                if init:
-                    log.debug('Sending initial frame to {}'.format(user))
-                    connection.response.write(self._current_frame)
+    async def _encode_silence(self, rendition):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *rendition.ffmpeg_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                loop=self._bot.loop)
+        except FileNotFoundError as e:
+            raise RuntimeError('ffmpeg executable was not found') from e
+        stdout, stderr = await process.communicate(self._silence_input)
+        if process.returncode:
+            raise RuntimeError('Silence encoding failed: {}'.format(stderr.decode('utf-8', 'replace').strip()))
+        return _split_frames(stdout, rendition.framer_factory())
+
+    async def _first_listener_init(self, rendition):
+        log.debug('First listener initialization of {}'.format(rendition.path))
+        if rendition.silence is None:
+            rendition.silence = await self._encode_silence(rendition)
+
+        # spawn ffmpeg process, pipes are kept open by the supervisor, so they survive the restarts
+        encoder_input, rendition.encoder_input = os.pipe2(os.O_CLOEXEC)
+        encoder_output, encoder_output_writer = os.pipe2(os.O_CLOEXEC)
+        os.set_blocking(encoder_output, False)
+        rendition.encoder = supervisor.ProcessSupervisor(
+            self._bot.loop, 'Encoder {}'.format(rendition.path), rendition.ffmpeg_args, stdin=encoder_input,
+            stdout=encoder_output_writer, spawn_callback=self._bot.scheduling.setup_ffmpeg_process,
+            restart_policy=supervisor.RestartPolicy.ON_FAILURE)
+        try:
+            await rendition.encoder.start()
+        except RuntimeError:
+            os.close(rendition.encoder_input)
+            os.close(encoder_output)
+            rendition.encoder = None
+            raise
+
+        # feed the encoder from the ring buffer, 10 frames at once at most
+        pcm_feeder = PcmFeeder('PcmFeeder {}'.format(rendition.path), self._pcm_ring.reader(10),
+                               rendition.encoder_input, self._bot.voice.encoder.frame_length / 1000,
+                               self._bot.scheduling)
+        rendition.pcm_feeder = pcm_feeder
+        # create processing thread
+        rendition.processor = StreamProcessor('StreamProcessor {}'.format(rendition.path), encoder_output,
+                                              rendition.framer_factory(), rendition.bitrate * 1000, self._bot.clock,
+                                              self._bot.scheduling, rendition.silence, self._program,
+                                              lambda: pcm_feeder.latency,
+                                              functools.partial(self._play_audio, rendition))
+        # enable input and output
+        rendition.connected.set()
+        rendition.pcm_feeder.start()
+        rendition.processor.start()
+        # spawn cleanup task
+        rendition.cleanup_task = self._bot.loop.create_task(self._cleanup_loop(rendition))
+
+    def _play_audio(self, rendition, data, duration):
+        # called by the StreamProcessor thread, the event loop is woken up only if it is not about to run already
+        rendition.handoff.append((data, duration))
+        if not rendition.handoff_scheduled:
+            rendition.handoff_scheduled = True
+            self._bot.loop.call_soon_threadsafe(self._fan_out, rendition)
+
+    def _fan_out(self, rendition):
+        # flag is cleared first, so the data appended from now on are either processed here or scheduled again
+        rendition.handoff_scheduled = False
+        while rendition.handoff:
+            frame, duration = rendition.handoff.popleft()
+            position = rendition.position
+            rendition.position += len(frame)
+
+            # buffers with the metadata interleaved are composed at most once per frame and shared by the clients
+            boundary = position % self._block_size + len(frame) >= self._block_size
+            with_meta = None
+            with_zero = None
+            if boundary and rendition.meta_changed:
+                log.debug('Sending new metadata to {}'.format(rendition.path))
+
+            for user, connection in rendition.connections.items():
+                if connection.closed:
+                    continue
+                if not boundary or not connection.meta:
+                    data = frame
+                elif connection.first_meta or rendition.meta_changed:
+                    if with_meta is None:
+                        with_meta = self._interleave(frame, position, self._current_meta)
+                    data = with_meta
                 else:
-                    connection.response.write(data)
+                    if with_zero is None:
+                        with_zero = self._interleave(frame, position, b'\0')
+                    data = with_zero
 
-                # now, if the frame is complete, append the metadata
-                if connection.meta and len(self._current_frame) == self._frame_len:
-                    if init or self._meta_changed:
-                        log.debug('Sending metadata to {}'.format(user))
-                        connection.response.write(self._current_meta)
-                    else:
-                        connection.response.write(b'\0')
+                if not connection.send(data):
+                    connection.terminate('queue overflow')
 
-            if len(self._current_frame) == self._frame_len:
+            if boundary:
                 # metadata were sent
-                self._meta_changed = False
-
-    def _last_listener_cleanup(self):
-        log.debug('Last listener deinitialization')
+                rendition.meta_changed = False
+            self._remember_frame(rendition, frame, duration, position)
+
+    def _interleave(self, frame, position, meta):
+        # metadata are inserted at the block boundaries crossed by the frame, the given ones at the first of them
+        chunks = list()
+        offset = 0
+        boundary = self._block_size - position % self._block_size
+        while boundary <= len(frame):
+            chunks.append(frame[offset:boundary])
+            chunks.append(meta)
+            meta = b'\0'
+            offset = boundary
+            boundary += self._block_size
+        chunks.append(frame[offset:])
+        return b''.join(chunks)
+
+    def _remember_frame(self, rendition, frame, duration, position):
+        if not self._burst_length:
+            return
+        rendition.burst.append((frame, duration, position))
+        rendition.burst_duration += duration
+        # the oldest frames are forgotten, so the burst is never longer than configured
+        while rendition.burst_duration > self._burst_length:
+            rendition.burst_duration -= rendition.burst.popleft()[1]
+
+    def _send_burst(self, rendition, user, connection):
+        # connection always starts with a whole frame, the next frames will follow seamlessly
+        frames = list(rendition.burst)
+        chunks = list()
+        if connection.meta:
+            # burst starts with the first frame of a block, so the padding below is as short as possible
+            for index in range(1, len(frames)):
+                if frames[index][2] // self._block_size != frames[index - 1][2] // self._block_size:
+                    frames = frames[index:]
+                    break
+            # client expects the metadata every block_size bytes, the beginning is padded with zeroes to match the
+            # block boundaries of the others, decoders skip the padding while looking for the first frame
+            position = frames[0][2] if frames else rendition.position
+            if position % self._block_size:
+                chunks.append(bytes(position % self._block_size))
+
+        for frame, _, position in frames:
+            if connection.meta and position % self._block_size + len(frame) >= self._block_size:
+                frame = self._interleave(frame, position, self._current_meta if connection.first_meta else b'\0')
+            chunks.append(frame)
+
+        # everything is sent using a single write
+        data = b''.join(chunks)
+        log.debug('Sending initial {} bytes of {} to {}'.format(len(data), rendition.path, user))
+        if not connection.send(data):
+            connection.terminate('queue overflow')
+
+    async def _last_listener_cleanup(self, rendition):
+        log.debug('Last listener deinitialization of {}'.format(rendition.path))
 
         # stop the input
-        self._connected.clear()
-        # kill ffmpeg process
-        self._ffmpeg.kill()
-        self._ffmpeg.communicate()
-        # kill processing thread
-        self._aac_thread.stop()
-        # flush internal pipe
-        try:
-            os.read(self._internal_pipe, 1048576)
-        except OSError as e:
-            if e.errno != errno.EAGAIN:
-                raise
-        # reinitialize some internal variables
-        self._current_frame = b''
-
-    async def _cleanup_loop(self):
+        rendition.connected.clear()
+        # feeder blocked in a write is released only after the encoder exits and the supervisor closes its end of the
+        # pipe, the encoder must be awaited before the feeder is joined, joining first could block the event loop
+        rendition.pcm_feeder.stop()
+        await rendition.encoder.stop()
+        rendition.pcm_feeder.join()
+        # kill processing thread, it must not measure the latency of the encoder input anymore
+        rendition.processor.stop()
+        os.close(rendition.encoder_input)
+        # reinitialize some internal variables, data not distributed yet are not needed anymore
+        rendition.encoder = None
+        rendition.encoder_input = None
+        rendition.pcm_feeder = None
+        rendition.processor = None
+        rendition.cleanup_task = None
+        rendition.handoff.clear()
+        rendition.position = 0
+        rendition.burst.clear()
+        rendition.burst_duration = 0.0
+
+    def _count_closed(self, user, connection):
+        self._stalls += connection.stalls
+        if connection.reason is None:
+            return
+        self._close_reasons[connection.reason] += 1
+
+        # clients leave all the time, only the kicks are worth attention
+        reasons = ', '.join('{} {}'.format(count, reason) for reason, count in self._close_reasons.items())
+        log.log(logging.DEBUG if connection.reason == 'disconnected' else logging.INFO,
+                'Connection with {} closed ({}, {} stall(s)), {} stall(s) so far, closed connections: {}'.format(
+                    user, connection.reason, connection.stalls, self._stalls, reasons))
+
+    async def _cleanup_loop(self, rendition):
         while True:
             # sleep for small amount of time
             await asyncio.sleep(1, loop=self._bot.loop)
@@ -382,26 +971,21 @@ class StreamServer:
             disconnected = list()
             # as this manipulates with connections, it is a critical section
             async with self._lock:
-                # iterate over all connections
-                for user, connection in self._connections.items():
-                    try:
-                        await asyncio.wait_for(connection.response.drain(), 0.001, loop=self._bot.loop)
-                    except (errors.DisconnectedError, asyncio.CancelledError, ConnectionResetError):
-                        log.debug('Connection broke with {}'.format(user))
-                        disconnected.append(user)
-                    except asyncio.TimeoutError:
-                        log.debug('Connection stalled with {}'.format(user))
+                # iterate over all connections, clients are served by their handlers
+                for user, connection in rendition.connections.items():
+                    if connection.closed:
                         disconnected.append(user)
+                        self._count_closed(user, connection)
 
                 # now we can pop disconnected listeners and notify the UserManager
                 for user in disconnected:
-                    self._connections.pop(user)
+                    rendition.connections.pop(user)
                     try:
                         await self._bot.users.remove_listener(user, direct=True)
                     except ValueError:
                         log.warning('Connection broke with {}, but the user was not listening'.format(user))
 
                 # cleanup must be done here because the original handler won't be resumed
-                if not self._connections:
-                    self._last_listener_cleanup()
+                if not rendition.connections:
+                    await self._last_listener_cleanup(rendition)
                     return
@@ -0,0 +1,182 @@
+import asyncio
+import enum
+import logging
+import os
+import subprocess
+from contextlib import suppress
+
+# set up the logger
+log = logging.getLogger('ddmbot.supervisor')
+
+
+class RestartPolicy(enum.Enum):
+    NEVER = 0
+    ON_FAILURE = 1
+
+
+class ProcessSupervisor:
+    def __init__(self, loop, name, args, *, stdin=None, stdout=None, pass_fds=(), spawn_callback=None,
+                 restart_policy=RestartPolicy.NEVER, max_restarts=3, restart_delay=1.0, progress=None,
+                 stall_timeout=0):
+        if progress is not None and not callable(progress):
+            raise TypeError('Progress must be a callable object')
+        if spawn_callback is not None and not callable(spawn_callback):
+            raise TypeError('Spawn callback must be a callable object')
+
+        self._loop = loop
+        self._name = name
+        self._args = args
+        # file descriptors passed to the child processes are owned by the supervisor, they are closed once the
+        # supervision is over, so the other end of the pipes sees the end of the input only after the last restart
+        self._stdin = stdin
+        self._stdout = stdout
+        self._pass_fds = tuple(pass_fds)
+        # called with the name and the pid after each spawn, e.g. to set up the scheduling of the process from outside
+        self._spawn_callback = spawn_callback
+
+        self._restart_policy = restart_policy
+        self._max_restarts = max_restarts
+        self._restart_delay = restart_delay
+        # progress returns a tuple (counter, starving), process is stalled if the consumer is starving and the counter
+        # does not change for the stall_timeout seconds
+        self._progress = progress
+        self._stall_timeout = stall_timeout
+
+        self._process = None
+        self._task = None
+        self._stopping = asyncio.Event(loop=loop)
+        self._restarts = 0
+        self._returncode = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def running(self):
+        return self._process is not None and self._process.returncode is None
+
+    @property
+    def returncode(self):
+        # exit status of the last process, None until the supervision is over
+        return self._returncode
+
+    @property
+    def restarts(self):
+        return self._restarts
+
+    async def start(self):
+        try:
+            await self._spawn()
+        except:
+            self._close_fds()
+            raise
+        self._task = self._loop.create_task(self._supervise())
+
+    def send_signal(self, signal):
+        if self.running:
+            self._process.send_signal(signal)
+
+    def kill(self):
+        # does not wait for anything, the process is not restarted anymore
+        self._stopping.set()
+        if self.running:
+            self._process.kill()
+
+    async def wait(self):
+        # waits for the end of the supervision without stopping anything, the supervision is not cancelled
+        if self._task is not None:
+            await asyncio.shield(self._task, loop=self._loop)
+        return self._returncode
+
+    async def stop(self):
+        # termination is awaited without blocking the event loop
+        self.kill()
+        if self._task is not None:
+            await self._task
+        return self._returncode
+
+    async def _spawn(self):
+        try:
+            self._process = await asyncio.create_subprocess_exec(
+                *self._args, stdin=self._stdin, stdout=self._stdout, stderr=subprocess.PIPE, pass_fds=self._pass_fds,
+                loop=self._loop)
+        except FileNotFoundError as e:
+            raise RuntimeError('ffmpeg executable was not found') from e
+        except subprocess.SubprocessError as e:
+            raise RuntimeError('Process creation failed: {0.__name__} {1}'.format(type(e), str(e))) from e
+        if self._spawn_callback is not None:
+            self._spawn_callback(self._name, self._process.pid)
+
+    async def _supervise(self):
+        try:
+            while True:
+                stderr_task = self._loop.create_task(self._log_stderr(self._process.stderr))
+                watchdog_task = None
+                if self._progress is not None and self._stall_timeout:
+                    watchdog_task = self._loop.create_task(self._watchdog())
+
+                returncode = await self._process.wait()
+                await stderr_task
+                if watchdog_task is not None:
+                    watchdog_task.cancel()
+                    with suppress(asyncio.CancelledError):
+                        await watchdog_task
+
+                if self._stopping.is_set() or not self._should_restart(returncode):
+                    break
+
+                self._restarts += 1
+                log.warning('{}: Process exited with status {}, restarting ({}/{})'.format(
+                    self._name, returncode, self._restarts, self._max_restarts))
+                # stop request is not delayed by the restart delay
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._stopping.wait(), self._restart_delay, loop=self._loop)
+                if self._stopping.is_set():
+                    break
+                try:
+                    await self._spawn()
+                except RuntimeError:
+                    log.exception('{}: Process restart failed'.format(self._name))
+                    break
+        finally:
+            self._returncode = self._process.returncode
+            self._close_fds()
+
+    def _should_restart(self, returncode):
+        if self._restart_policy == RestartPolicy.NEVER:
+            return False
+        return returncode != 0 and self._restarts < self._max_restarts
+
+    async def _log_stderr(self, stream):
+        while True:
+            line = await stream.readline()
+            if not line:
+                return
+            log.warning('{}: {}'.format(self._name, line.decode('utf-8', 'replace').rstrip()))
+
+    async def _watchdog(self):
+        last_counter = self._progress()[0]
+        stalled_since = None
+        while True:
+            await asyncio.sleep(self._stall_timeout / 4, loop=self._loop)
+            counter, starving = self._progress()
+            if counter != last_counter or not starving:
+                last_counter = counter
+                stalled_since = None
+            elif stalled_since is None:
+                stalled_since = self._loop.time()
+            elif self._loop.time() - stalled_since >= self._stall_timeout:
+                log.warning('{}: No output for {} seconds, process is considered stalled'.format(
+                    self._name, self._stall_timeout))
+                # the restart policy applies, as for any other failure
+                self._process.kill()
+                return
+
+    def _close_fds(self):
+        for fd in (self._stdin, self._stdout) + self._pass_fds:
+            if isinstance(fd, int) and fd >= 0:
+                with suppress(OSError):
+                    os.close(fd)
+        self._stdin = self._stdout = None
+        self._pass_fds = ()
@@ -0,0 +1,53 @@
+import asyncio
+import os
+import signal
+import unittest
+
+import supervisor
+from player import FrameRing
+
+
+class FrameRingTest(unittest.TestCase):
+    def setUp(self):
+        self._read_fd, self._write_fd = os.pipe2(os.O_CLOEXEC)
+        os.set_blocking(self._read_fd, False)
+
+    def tearDown(self):
+        for fd in (self._read_fd, self._write_fd):
+            if fd is not None:
+                os.close(fd)
+
+    def test_buffering_check_reports_starving(self):
+        ring = FrameRing(self._read_fd, 4, 4)
+        self.assertEqual(ring.buffered(), 0)
+        self.assertTrue(ring.progress()[1])
+        os.write(self._write_fd, bytes(4))
+        self.assertEqual(ring.buffered(), 1)
+        self.assertFalse(ring.progress()[1])
+
+    def test_input_without_data_is_stalled(self):
+        # decoder stuck before its first frame, e.g. in a connect, is killed while the input is being buffered
+        loop = asyncio.new_event_loop()
+        ring = FrameRing(self._read_fd, 3840, 25)
+        process = supervisor.ProcessSupervisor(loop, 'Decoder (test)', ['sleep', '30'], stdout=self._write_fd,
+                                               progress=ring.progress, stall_timeout=0.2)
+        self._write_fd = None  # owned by the supervisor
+
+        async def prebuffer():
+            await process.start()
+            # PCM thread keeps checking the buffered frames while waiting for the target level
+            while process.running:
+                ring.buffered()
+                await asyncio.sleep(0.01, loop=loop)
+            return await process.wait()
+
+        try:
+            returncode = loop.run_until_complete(asyncio.wait_for(prebuffer(), 5, loop=loop))
+        finally:
+            loop.close()
+        self.assertEqual(returncode, -signal.SIGKILL)
+        self.assertTrue(ring.progress()[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
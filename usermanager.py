@@ -97,6 +97,9 @@ class UserManager:
             self._queue.append(discord_id)
             return discord_id
 
+    def peek_next_dj(self):
+        return self._queue[0] if self._queue else None
+
     async def clear_queue(self):
         async with self._lock:
             self._queue.clear()